@@ -54,69 +54,47 @@ pipeline {
                     }
 
                     def server = params.SERVER_TO_DISABLE
-                    def cmd = ""
+                    def ops = []
 
                     // ---------------------------
-                    // Generate sed commands
+                    // Upstream changes (ACTION:ADDRESS, applied in order)
                     // ---------------------------
                     if (server == "172.20.4.102:9090" && params.ACTION == "DISABLE") {
 
-                        cmd = """
-                            sudo sed -i "s/^ *server 172.20.4.102:9090/# server 172.20.4.102:9090/" ${NGINX_FILE}
-                            sudo sed -i "/pgRequestServer/,/}/ s/ backup//g" ${NGINX_FILE}
-                        """
+                        ops = ["--op disable:172.20.4.102:9090", "--op 'nobackup:*'"]
 
                     } else if (server == "172.20.4.102:9090" && params.ACTION == "ENABLE") {
 
-                        cmd = """
-                            sudo sed -i "s/^# server 172.20.4.102:9090/server 172.20.4.102:9090/" ${NGINX_FILE}
-                            sudo sed -i "/pgRequestServer/,/}/ s/server 172.20.5.28:9090;/server 172.20.5.28:9090 backup;/" ${NGINX_FILE}
-                            sudo sed -i "/pgRequestServer/,/}/ s/server 172.20.4.181:9090;/server 172.20.4.181:9090 backup;/" ${NGINX_FILE}
-                        """
+                        ops = [
+                            "--op enable:172.20.4.102:9090",
+                            "--op backup:172.20.5.28:9090",
+                            "--op backup:172.20.4.181:9090"
+                        ]
 
                     } else if (params.ACTION == "DISABLE") {
 
-                        cmd = """
-                            sudo sed -i "s/^ *server ${server}/# server ${server}/" ${NGINX_FILE}
-                        """
+                        ops = ["--op disable:${server}"]
 
                     } else if (params.ACTION == "ENABLE") {
 
-                        cmd = """
-                            sudo sed -i "s/^# server ${server}/server ${server}/" ${NGINX_FILE}
-                        """
+                        ops = ["--op enable:${server}"]
                     }
 
                     // ---------------------------
-                    // Build remote command
+                    // Apply on all selected hosts in one call
+                    // (parallel edit, batch nginx -t, rollback on failure)
                     // ---------------------------
-                    def remoteCmd = """
-                        ${cmd}
-                        sudo nginx -t
-                        echo "\\n======= Showing first 200 lines of localhost config ======="
-                        sudo sed -n '1,200p' ${NGINX_FILE}
+                    def reloadFlag = params.RELOAD_NGINX == "YES" ? "--reload" : ""
+                    echo "Applying changes on Nginx server(s): ${targetHosts.join(', ')}"
+
+                    sh """
+                        python3 ${WORKSPACE}/Jenkins/Nginx/nginx_upstream.py \\
+                            --hosts ${targetHosts.join(',')} \\
+                            --ssh-key ${SSH_KEY} \\
+                            --file ${NGINX_FILE} \\
+                            ${ops.join(' ')} \\
+                            ${reloadFlag} --show 200
                     """
-
-                    // Reload at the very end if selected
-                    if (params.RELOAD_NGINX == "YES") {
-                        remoteCmd += """
-                            sudo systemctl reload nginx
-                            echo "Nginx reloaded successfully!"
-                        """
-                    }
-
-                    // ---------------------------
-                    // Execute on selected hosts
-                    // ---------------------------
-                    targetHosts.each { host ->
-                        echo "Applying changes on Nginx server: ${host}"
-
-                        sh """
-                            ssh -o StrictHostKeyChecking=no -i ${SSH_KEY} ec2-user@${host} '
-                                ${remoteCmd}
-                            '
-                        """
-                    }
                 }
             }
         }
@@ -53,52 +53,36 @@ pipeline {
                     }
 
                     def server = params.SERVER_TO_DISABLE
-                    def cmd = ""
+                    def ops = []
 
                     // ---------------------------
-                    // Generate sed commands
+                    // Upstream changes (ACTION:ADDRESS)
                     // ---------------------------
-
                     if (params.ACTION == "DISABLE") {
-                        cmd = """sudo sed -i "s/^\\s*server ${server}/# server ${server}/" ${NGINX_FILE}"""
+                        ops = ["--op disable:${server}"]
 
                     } else if (params.ACTION == "ENABLE") {
-                        cmd = """sudo sed -i "s/^# server ${server}/server ${server}/" ${NGINX_FILE}"""
+                        ops = ["--op enable:${server}"]
 
                     } else {
                         error("Invalid ACTION parameter: ${params.ACTION}")
                     }
 
                     // ---------------------------
-                    // Build remote command
+                    // Apply on all selected hosts in one call
+                    // (parallel edit, batch nginx -t, rollback on failure)
                     // ---------------------------
-                    def remoteCmd = """
-                        ${cmd}
-                        sudo nginx -t
-                        echo "\\n======= Showing first 200 lines of localhost config ======="
-                        sudo sed -n '1,200p' ${NGINX_FILE}
+                    def reloadFlag = params.RELOAD_NGINX == "YES" ? "--reload" : ""
+                    echo "Applying changes on Nginx server(s): ${targetHosts.join(', ')}"
+
+                    sh """
+                        python3 ${WORKSPACE}/Jenkins/Nginx/nginx_upstream.py \\
+                            --hosts ${targetHosts.join(',')} \\
+                            --ssh-key ${SSH_KEY} \\
+                            --file ${NGINX_FILE} \\
+                            ${ops.join(' ')} \\
+                            ${reloadFlag} --show 200
                     """
-
-                    // Reload at the very end if selected
-                    if (params.RELOAD_NGINX == "YES") {
-                        remoteCmd += """
-                            sudo systemctl reload nginx
-                            echo "Nginx reloaded successfully!"
-                        """
-                    }
-
-                    // ---------------------------
-                    // Execute on selected hosts
-                    // ---------------------------
-                    targetHosts.each { host ->
-                        echo "Applying changes on Nginx server: ${host}"
-
-                        sh """
-                            ssh -o StrictHostKeyChecking=no -i ${SSH_KEY} ec2-user@${host} '
-                                ${remoteCmd}
-                            '
-                        """
-                    }
                 }
             }
         }
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""Toggle servers in an Nginx upstream block on many hosts at once.
+
+Replaces the per-pipeline sed scripts in *_Migration.groovy. Each host's
+config is read once, every enable/disable/backup change is applied to the
+parsed upstream in memory, and the result is written back atomically via
+a hidden temp file in the same directory (nginx's `include .../*;` glob
+skips dotfiles). Validation (nginx -t) then runs on all hosts as one
+batch; if any host fails, every edited host is rolled back by rewriting
+the original contents held in memory, and nothing is reloaded. No backup
+file is left next to the config, where the include glob would load it.
+
+Example (what On_Migration does for ENABLE of the primary):
+
+    nginx_upstream.py --hosts 172.31.42.57 --ssh-key key.pem \\
+        --op enable:172.20.4.102:9090 \\
+        --op backup:172.20.5.28:9090 --op backup:172.20.4.181:9090 \\
+        --reload --show 200
+"""
+import argparse
+import logging
+import os
+import re
+import shlex
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("nginx_upstream")
+
+# CONFIG
+NGINX_FILE = "/etc/nginx/sites-enabled/localhost"
+UPSTREAM = "pgRequestServer"
+SSH_USER = "ec2-user"
+VALIDATE_CMD = "nginx -t"
+RELOAD_CMD = "systemctl reload nginx"
+
+OPS = ("enable", "disable", "backup", "nobackup")
+
+UPSTREAM_RE = re.compile(r"^\s*upstream\s+(\S+)\s*\{")
+SERVER_RE = re.compile(r"^(?P<indent>\s*)(?P<comment>#\s*)?server\s+(?P<addr>[^\s;]+)(?P<params>[^;]*);(?P<tail>.*)$")
+
+
+class UpstreamError(Exception):
+    pass
+
+
+# ----------------------------------------------------------------------
+# CONFIG PARSING / EDITING
+# ----------------------------------------------------------------------
+def find_servers(lines, upstream):
+    """Return {address: [line index, ...]} for server lines in the upstream.
+
+    Commented-out (disabled) servers are included.
+    """
+    servers = {}
+    inside = False
+    found = False
+    for i, line in enumerate(lines):
+        if not inside:
+            m = UPSTREAM_RE.match(line)
+            if m and m.group(1) == upstream:
+                inside = found = True
+            continue
+        if line.strip().startswith("}"):
+            inside = False
+            continue
+        m = SERVER_RE.match(line)
+        if m:
+            servers.setdefault(m.group("addr"), []).append(i)
+    if not found:
+        raise UpstreamError(f"upstream {upstream} not found")
+    return servers
+
+
+def render_server(m, enabled, backup):
+    params = [p for p in m.group("params").split() if p != "backup"]
+    if backup:
+        params.append("backup")
+    prefix = "" if enabled else "# "
+    return f"{m.group('indent')}{prefix}server {' '.join([m.group('addr')] + params)};{m.group('tail')}"
+
+
+def apply_ops(text, ops, upstream=UPSTREAM):
+    """Apply [(op, address)] in order to the upstream; returns the new text.
+
+    Address "*" targets every server in the upstream. Lines outside the
+    upstream, and parts of server lines the op doesn't touch, are kept as-is.
+    """
+    lines = text.split("\n")
+    servers = find_servers(lines, upstream)
+
+    for op, addr in ops:
+        if op not in OPS:
+            raise UpstreamError(f"unknown op {op!r}, expected one of {OPS}")
+        if addr == "*":
+            targets = [i for idxs in servers.values() for i in idxs]
+        elif addr in servers:
+            targets = servers[addr]
+        else:
+            raise UpstreamError(f"server {addr} not found in upstream {upstream}")
+
+        for i in targets:
+            m = SERVER_RE.match(lines[i])
+            enabled = m.group("comment") is None
+            backup = "backup" in m.group("params").split()
+            if op == "enable":
+                enabled = True
+            elif op == "disable":
+                enabled = False
+            else:
+                backup = op == "backup"
+            lines[i] = render_server(m, enabled, backup)
+
+    return "\n".join(lines)
+
+
+def parse_op(value):
+    op, sep, addr = value.partition(":")
+    if not sep or not addr:
+        raise argparse.ArgumentTypeError(f"expected ACTION:ADDRESS, got {value!r}")
+    if op not in OPS:
+        raise argparse.ArgumentTypeError(f"unknown action {op!r}, expected one of {OPS}")
+    return op, addr
+
+
+# ----------------------------------------------------------------------
+# EXECUTORS
+# ----------------------------------------------------------------------
+class SSHExecutor:
+    """Runs commands over SSH, one multiplexed connection per host.
+
+    The first command to a host opens an OpenSSH ControlMaster; later
+    commands reuse it instead of doing a new handshake. close() tears the
+    masters down.
+    """
+
+    def __init__(self, user=SSH_USER, key_file=None, connect_timeout=10):
+        self.user = user
+        self.key_file = key_file
+        self.connect_timeout = connect_timeout
+        self.control_dir = tempfile.mkdtemp(prefix="nginx-ssh-")
+        self.hosts = set()
+
+    def _base(self, host):
+        cmd = [
+            "ssh",
+            "-o", "StrictHostKeyChecking=no",
+            "-o", "BatchMode=yes",
+            "-o", f"ConnectTimeout={self.connect_timeout}",
+            "-o", "ControlMaster=auto",
+            "-o", f"ControlPath={self.control_dir}/%C",
+            "-o", "ControlPersist=120",
+        ]
+        if self.key_file:
+            cmd += ["-i", self.key_file]
+        return cmd + [f"{self.user}@{host}"]
+
+    def run(self, host, command, input=None):
+        self.hosts.add(host)
+        return subprocess.run(self._base(host) + [command], input=input,
+                              capture_output=True, text=True)
+
+    def close(self):
+        for host in self.hosts:
+            subprocess.run(self._base(host)[:-1] + ["-O", "exit", f"{self.user}@{host}"],
+                           capture_output=True)
+        self.hosts.clear()
+        try:
+            os.rmdir(self.control_dir)
+        except OSError:
+            pass
+
+
+class LocalExecutor:
+    """Stand-in for SSHExecutor that runs commands on this machine.
+
+    roots maps host -> working directory, so each "host" can have its own
+    copy of the config when given a relative --file path.
+    """
+
+    def __init__(self, roots=None):
+        self.roots = roots or {}
+
+    def run(self, host, command, input=None):
+        return subprocess.run(["sh", "-c", command], input=input, cwd=self.roots.get(host),
+                              capture_output=True, text=True)
+
+    def close(self):
+        pass
+
+
+# ----------------------------------------------------------------------
+# MULTI-HOST MIGRATION
+# ----------------------------------------------------------------------
+class UpstreamMigration:
+    """Edit, validate and reload the upstream on a set of hosts in parallel."""
+
+    def __init__(self, executor, path=NGINX_FILE, upstream=UPSTREAM, sudo="sudo",
+                 validate_cmd=VALIDATE_CMD, reload_cmd=RELOAD_CMD, max_workers=8):
+        self.executor = executor
+        self.path = path
+        self.upstream = upstream
+        self.sudo = f"{sudo} " if sudo else ""
+        self.validate_cmd = validate_cmd
+        self.reload_cmd = reload_cmd
+        self.max_workers = max_workers
+
+    def _run(self, host, command, input=None):
+        result = self.executor.run(host, command, input=input)
+        if result.returncode != 0:
+            raise UpstreamError(f"{host}: `{command}` failed: {result.stderr.strip() or result.stdout.strip()}")
+        return result.stdout
+
+    def _each(self, hosts, fn):
+        """Run fn(host) for every host concurrently; returns {host: result or exception}."""
+        def _call(host):
+            try:
+                return fn(host)
+            except Exception as e:
+                return e
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(hosts)) or 1) as pool:
+            return dict(zip(hosts, pool.map(_call, hosts)))
+
+    def write(self, host, text):
+        """Atomically replace the config: hidden temp file in the same dir, then mv.
+
+        The temp file is removed if any step fails.
+        """
+        path = shlex.quote(self.path)
+        directory = shlex.quote(os.path.dirname(self.path) or ".")
+        template = shlex.quote(f".{os.path.basename(self.path)}.XXXXXX")
+        s = self.sudo
+        self._run(host,
+                  f"tmp=$({s}mktemp -p {directory} {template}) || exit 1; "
+                  f"trap '{s}rm -f \"$tmp\"' EXIT; "
+                  f"{s}tee \"$tmp\" >/dev/null && "
+                  f"{s}chmod --reference={path} \"$tmp\" && "
+                  f"{s}chown --reference={path} \"$tmp\" && "
+                  f"{s}mv \"$tmp\" {path}",
+                  input=text)
+
+    def edit(self, host, ops):
+        """Read once, edit in memory, write if changed; returns (original, new_text)."""
+        text = self._run(host, f"{self.sudo}cat {shlex.quote(self.path)}")
+        new_text = apply_ops(text, ops, self.upstream)
+        if new_text != text:
+            self.write(host, new_text)
+        return text, new_text
+
+    def apply(self, hosts, ops, reload=False):
+        """Returns {host: {"changed", "text"}}; raises UpstreamError after rolling back."""
+        hosts = list(dict.fromkeys(hosts))
+
+        # 1) Edit every host in parallel
+        edits = self._each(hosts, lambda h: self.edit(h, ops))
+        changed = [h for h, r in edits.items() if not isinstance(r, Exception) and r[0] != r[1]]
+        errors = [r for r in edits.values() if isinstance(r, Exception)]
+
+        # 2) Validate all hosts as one batch (only if every edit succeeded)
+        if not errors:
+            checks = self._each(hosts, lambda h: self._run(h, f"{self.sudo}{self.validate_cmd}"))
+            errors = [r for r in checks.values() if isinstance(r, Exception)]
+
+        if errors:
+            rollback = lambda h: self.write(h, edits[h][0])
+            for host, r in self._each(changed, rollback).items():
+                if isinstance(r, Exception):
+                    logger.error(f"{host}: rollback failed: {r}")
+            raise UpstreamError("; ".join(str(e) for e in errors))
+
+        # 3) Reload all hosts as one batch
+        if reload:
+            reloads = self._each(hosts, lambda h: self._run(h, f"{self.sudo}{self.reload_cmd}"))
+            errors = [r for r in reloads.values() if isinstance(r, Exception)]
+            if errors:
+                raise UpstreamError("; ".join(str(e) for e in errors))
+
+        return {h: {"changed": h in changed, "text": edits[h][1]} for h in hosts}
+
+
+# ----------------------------------------------------------------------
+# CLI
+# ----------------------------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Enable/disable/backup servers in an Nginx upstream on many hosts.")
+    parser.add_argument("--hosts", required=True, help="Comma-separated host list")
+    parser.add_argument("--op", dest="ops", action="append", type=parse_op, required=True,
+                        metavar="ACTION:ADDRESS",
+                        help=f"One of {', '.join(OPS)}; repeat, applied in order. ADDRESS '*' = all servers")
+    parser.add_argument("--file", default=NGINX_FILE, help="Nginx config path on the hosts")
+    parser.add_argument("--upstream", default=UPSTREAM)
+    parser.add_argument("--user", default=SSH_USER)
+    parser.add_argument("--ssh-key", help="SSH private key file")
+    parser.add_argument("--reload", action="store_true", help="Reload Nginx after successful validation")
+    parser.add_argument("--show", type=int, default=0, metavar="N",
+                        help="Print the first N lines of the resulting config per host")
+    parser.add_argument("--validate-cmd", default=VALIDATE_CMD)
+    parser.add_argument("--reload-cmd", default=RELOAD_CMD)
+    parser.add_argument("--local", action="store_true",
+                        help="Run against this machine instead of SSH (no sudo)")
+    parser.add_argument("--max-workers", type=int, default=8)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    hosts = [h.strip() for h in args.hosts.split(",") if h.strip()]
+    executor = LocalExecutor() if args.local else SSHExecutor(args.user, args.ssh_key)
+    migration = UpstreamMigration(executor, path=args.file, upstream=args.upstream,
+                                  sudo="" if args.local else "sudo", validate_cmd=args.validate_cmd,
+                                  reload_cmd=args.reload_cmd, max_workers=args.max_workers)
+    try:
+        results = migration.apply(hosts, args.ops, reload=args.reload)
+    except UpstreamError as e:
+        logger.error(f"Migration failed, no host reloaded: {e}")
+        return 1
+    finally:
+        executor.close()
+
+    for host, r in results.items():
+        logger.info(f"{host}: {'updated' if r['changed'] else 'already up to date'}"
+                    f"{', reloaded' if args.reload else ''}")
+        if args.show:
+            logger.info(f"\n======= First {args.show} lines of {args.file} on {host} =======")
+            logger.info("\n".join(r["text"].split("\n")[:args.show]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from nginx_upstream import LocalExecutor, UpstreamError, UpstreamMigration, apply_ops  # noqa: E402
+
+CONF = """\
+upstream pgRequestServer {
+    server 172.20.4.102:9090;
+    server 172.20.5.28:9090 backup;
+# server 172.20.4.181:9090 max_fails=3 backup; # az-b
+}
+
+upstream reportServer {
+    server 172.20.4.102:9090 backup;
+}
+
+server {
+    listen 80;
+    location / { proxy_pass http://pgRequestServer; }
+}
+"""
+
+
+def line_for(text, addr, upstream="pgRequestServer"):
+    """The server line for addr inside the given upstream block."""
+    block = text.split(f"upstream {upstream} {{", 1)[1].split("}", 1)[0]
+    return next(l for l in block.split("\n") if addr in l)
+
+
+class ApplyOpsTest(unittest.TestCase):
+
+    def test_disable_keeps_indentation_and_params(self):
+        out = apply_ops(CONF, [("disable", "172.20.5.28:9090")])
+        self.assertEqual(line_for(out, "172.20.5.28"), "    # server 172.20.5.28:9090 backup;")
+
+    def test_enable_commented_unindented_line(self):
+        out = apply_ops(CONF, [("enable", "172.20.4.181:9090")])
+        self.assertEqual(line_for(out, "172.20.4.181"), "server 172.20.4.181:9090 max_fails=3 backup; # az-b")
+
+    def test_enable_already_enabled_is_noop(self):
+        self.assertEqual(apply_ops(CONF, [("enable", "172.20.4.102:9090")]), CONF)
+
+    def test_backup_and_nobackup_with_other_params(self):
+        out = apply_ops(CONF, [("nobackup", "172.20.4.181:9090")])
+        self.assertEqual(line_for(out, "172.20.4.181"), "# server 172.20.4.181:9090 max_fails=3; # az-b")
+        out = apply_ops(out, [("backup", "172.20.4.181:9090")])
+        self.assertEqual(out, CONF)
+
+    def test_star_targets_every_server_in_upstream(self):
+        out = apply_ops(CONF, [("disable", "172.20.4.102:9090"), ("nobackup", "*")])
+        self.assertEqual(line_for(out, "172.20.4.102"), "    # server 172.20.4.102:9090;")
+        self.assertEqual(line_for(out, "172.20.5.28"), "    server 172.20.5.28:9090;")
+        self.assertEqual(line_for(out, "172.20.4.181"), "# server 172.20.4.181:9090 max_fails=3; # az-b")
+
+    def test_same_server_in_other_upstream_untouched(self):
+        out = apply_ops(CONF, [("disable", "172.20.4.102:9090"), ("nobackup", "*")])
+        self.assertEqual(line_for(out, "172.20.4.102", "reportServer"), "    server 172.20.4.102:9090 backup;")
+        self.assertIn("location / { proxy_pass http://pgRequestServer; }", out)
+
+    def test_on_migration_round_trip(self):
+        disabled = apply_ops(CONF, [("disable", "172.20.4.102:9090"), ("nobackup", "*")])
+        enabled = apply_ops(disabled, [("enable", "172.20.4.102:9090"),
+                                       ("backup", "172.20.5.28:9090"),
+                                       ("enable", "172.20.4.181:9090"),
+                                       ("backup", "172.20.4.181:9090")])
+        self.assertEqual(line_for(enabled, "172.20.4.102"), "    server 172.20.4.102:9090;")
+        self.assertEqual(line_for(enabled, "172.20.5.28"), "    server 172.20.5.28:9090 backup;")
+
+    def test_unknown_server(self):
+        with self.assertRaisesRegex(UpstreamError, "not found in upstream"):
+            apply_ops(CONF, [("disable", "10.0.0.1:80")])
+
+    def test_missing_upstream(self):
+        with self.assertRaisesRegex(UpstreamError, "upstream nope not found"):
+            apply_ops(CONF, [("disable", "172.20.4.102:9090")], upstream="nope")
+
+
+class UpstreamMigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.roots = {h: tempfile.mkdtemp() for h in ("web1", "web2")}
+        for root in self.roots.values():
+            os.makedirs(os.path.join(root, "sites-enabled"))
+            with open(self.conf(root), "w") as f:
+                f.write(CONF)
+
+    def tearDown(self):
+        for root in self.roots.values():
+            shutil.rmtree(root)
+
+    def conf(self, root):
+        return os.path.join(root, "sites-enabled", "localhost")
+
+    def read(self, host):
+        with open(self.conf(self.roots[host])) as f:
+            return f.read()
+
+    def migration(self, validate_cmd="true"):
+        return UpstreamMigration(LocalExecutor(self.roots), path="sites-enabled/localhost", sudo="",
+                                 validate_cmd=validate_cmd, reload_cmd="touch reloaded")
+
+    def assert_no_stray_files(self):
+        for root in self.roots.values():
+            self.assertEqual(os.listdir(os.path.join(root, "sites-enabled")), ["localhost"])
+
+    def test_apply_success_on_two_hosts(self):
+        ops = [("disable", "172.20.5.28:9090")]
+        results = self.migration().apply(["web1", "web2", "web1"], ops, reload=True)
+
+        self.assertEqual(list(results), ["web1", "web2"])
+        expected = apply_ops(CONF, ops)
+        for host, root in self.roots.items():
+            self.assertTrue(results[host]["changed"])
+            self.assertEqual(self.read(host), expected)
+            self.assertTrue(os.path.exists(os.path.join(root, "reloaded")))
+        self.assert_no_stray_files()
+
+    def test_host_already_up_to_date(self):
+        ops = [("disable", "172.20.5.28:9090")]
+        with open(self.conf(self.roots["web2"]), "w") as f:
+            f.write(apply_ops(CONF, ops))
+
+        results = self.migration().apply(["web1", "web2"], ops)
+
+        self.assertTrue(results["web1"]["changed"])
+        self.assertFalse(results["web2"]["changed"])
+        self.assertEqual(self.read("web1"), self.read("web2"))
+        self.assertFalse(os.path.exists(os.path.join(self.roots["web1"], "reloaded")))
+
+    def test_rollback_when_validation_fails(self):
+        # web2's "nginx -t" fails
+        bad = os.path.basename(self.roots["web2"])
+        migration = self.migration(validate_cmd=f'test "$(basename "$PWD")" != {bad}')
+
+        with self.assertRaisesRegex(UpstreamError, "web2"):
+            migration.apply(["web1", "web2"], [("disable", "172.20.4.102:9090")], reload=True)
+
+        for host, root in self.roots.items():
+            self.assertEqual(self.read(host), CONF)
+            self.assertFalse(os.path.exists(os.path.join(root, "reloaded")))
+        self.assert_no_stray_files()
+
+    def test_unknown_server_leaves_hosts_untouched(self):
+        with self.assertRaisesRegex(UpstreamError, "not found"):
+            self.migration().apply(["web1", "web2"], [("disable", "10.0.0.1:80")])
+        self.assertEqual(self.read("web1"), CONF)
+        self.assertEqual(self.read("web2"), CONF)
+
+    def test_failed_write_removes_temp_file(self):
+        migration = self.migration()
+        migration.path = "sites-enabled/missing"  # chmod --reference fails
+        with self.assertRaises(UpstreamError):
+            migration.write("web1", CONF)
+        self.assert_no_stray_files()
+
+
+if __name__ == "__main__":
+    unittest.main()
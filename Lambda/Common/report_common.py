@@ -0,0 +1,219 @@
+"""Helpers shared by the IAM and Security Group report Lambdas.
+
+Shipped in the openpyxl layer (see IAM/GET_IAM_Layer.sh), so both handlers
+can `from report_common import ...` at runtime.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger()
+
+# Render/delivery cache. Lambda /tmp is wiped on every cold start, and the
+# scheduled daily run is almost always cold, so with the default directory
+# the cache only helps warm re-invocations. Set REPORT_CACHE_DIR to an EFS
+# mount (e.g. /mnt/reports/cache) to keep artifacts and delivery pointers
+# across days. Each report uses its own subdirectory.
+REPORT_CACHE_DIR = os.environ.get("REPORT_CACHE_DIR", "/tmp/report_cache")
+REPORT_CACHE_MAX_BYTES = 50 * 1024 * 1024
+REPORT_CACHE_MAX_AGE_SECONDS = 7 * 24 * 3600
+
+LAST_DELIVERED = "last-delivered"
+
+# Sentinel the pipelined fetch stage puts on the queue when it is finished
+PIPELINE_DONE = object()
+
+
+# ----------------------------------------------------------------------
+# CONTENT-ADDRESSED RENDER/DELIVERY CACHE
+# ----------------------------------------------------------------------
+class LocalReportCache:
+    """Workbook store keyed by content hash, with size/age eviction.
+
+    Pointers record the key last delivered for a report. Any object with
+    the same get/put/get_pointer/set_pointer methods (e.g. S3-backed) can
+    be used instead. Cache failures never fail a report.
+    """
+
+    def __init__(self, root: str, max_bytes: int = REPORT_CACHE_MAX_BYTES,
+                 max_age: int = REPORT_CACHE_MAX_AGE_SECONDS):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, re.sub(r"[^A-Za-z0-9_.-]", "_", name))
+
+    def _write(self, path: str, data: bytes):
+        # Unique temp name even across Lambda instances sharing an EFS cache
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    def get(self, key: str):
+        path = self._path(key + ".xlsx")
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # LRU: eviction drops least recently used first
+            return data
+        except OSError:
+            return None
+
+    def put(self, key: str, data: bytes):
+        try:
+            self._write(self._path(key + ".xlsx"), data)
+            self.evict()
+        except OSError as e:
+            logger.warning(f"Failed to cache report {key}: {e}")
+
+    def get_pointer(self, name: str):
+        try:
+            with open(self._path(name + ".ptr")) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def set_pointer(self, name: str, key: str):
+        try:
+            self._write(self._path(name + ".ptr"), key.encode("utf-8"))
+        except OSError as e:
+            logger.warning(f"Failed to record delivered report {key}: {e}")
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.name.endswith(".xlsx"):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        entries.sort()
+        now = time.time()
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            if now - mtime <= self.max_age and total <= self.max_bytes:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+def content_hash(template_version: str, rows: dict) -> str:
+    """SHA-256 of the canonical JSON of the report rows + template version."""
+    canonical = json.dumps({"template": template_version, **rows},
+                           sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def delivery_pointer(ident) -> str:
+    """Pointer name for whatever identifies one delivery (JSON-serialisable)."""
+    digest = hashlib.sha256(json.dumps(ident, sort_keys=True).encode("utf-8")).hexdigest()
+    return f"{LAST_DELIVERED}-{digest[:16]}"
+
+
+def subscription_pointer(sub: dict) -> str:
+    """Delivery pointer name: unique per subscription name + recipient set."""
+    return delivery_pointer([sub.get("name", ""), sorted(sub["recipients"])])
+
+
+# ----------------------------------------------------------------------
+# SUBSCRIPTION FAN-OUT
+# ----------------------------------------------------------------------
+class SendRateLimiter:
+    """Spaces SES calls across threads to stay under max_rate sends/sec."""
+
+    def __init__(self, max_rate: float):
+        self.interval = 1.0 / max_rate
+        self.lock = threading.Lock()
+        self.next_at = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_at)
+            self.next_at = slot + self.interval
+        time.sleep(max(0.0, slot - now))
+
+
+def workbook_bytes(wb) -> bytes:
+    # In-memory save: concurrent renders must not share a /tmp path
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+
+def validate_subscriptions(subscriptions, filter_types: dict):
+    """Return an error message for a bad subscription config, else None.
+
+    filter_types maps each report's filter keys to their expected type.
+    """
+    if not isinstance(subscriptions, list):
+        return "subscriptions must be a list of objects"
+    seen = set()
+    for sub in subscriptions:
+        if not isinstance(sub, dict):
+            return "Each subscription must be an object"
+        name = sub.get("name", "")
+        recipients = sub.get("recipients")
+        if not isinstance(recipients, list) or not recipients or \
+                not all(isinstance(r, str) and r for r in recipients):
+            return f"Subscription {name!r} needs a non-empty list of recipient addresses"
+        for key, kind in filter_types.items():
+            if sub.get(key) is not None and not isinstance(sub[key], kind):
+                return f"Subscription {name!r}: {key} must be a {kind.__name__}"
+        # Name + recipients key the delivery pointer, so they must be unique
+        ident = (name, tuple(sorted(recipients)))
+        if (name and name in seen) or ident in seen:
+            return f"Duplicate subscription {name or recipients!r}"
+        seen.update([name, ident])
+    return None
+
+
+# ----------------------------------------------------------------------
+# QUERY MODE
+# ----------------------------------------------------------------------
+def validate_query_filters(filters, allowed):
+    """Return an error message for a bad query "filters" object, else None.
+
+    Each value is a string/number, or a non-empty list of them (ORed).
+    """
+    if not isinstance(filters, dict):
+        return "filters must be an object"
+    unknown = sorted(set(filters) - set(allowed))
+    if unknown:
+        return f"Unknown filters: {unknown} (allowed: {sorted(allowed)})"
+    for name, value in filters.items():
+        values = value if isinstance(value, list) else [value]
+        if not values or not all(isinstance(v, (str, int, float)) for v in values):
+            return f"Filter {name!r} must be a string/number or a non-empty list of them"
+    return None
+
+
+# ----------------------------------------------------------------------
+# PIPELINED MODE
+# ----------------------------------------------------------------------
+def stop_pipeline(out_q, stop: threading.Event, fetcher: threading.Thread):
+    # Unblock fetch workers stuck on put() and wait for the fetch stage to end,
+    # so no threads are left behind in a warm container.
+    stop.set()
+    while out_q.get() is not PIPELINE_DONE:
+        pass
+    fetcher.join()
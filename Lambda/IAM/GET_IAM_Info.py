@@ -2,10 +2,18 @@ import boto3
 import json
 import logging
 import base64
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from openpyxl import Workbook
 from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
 from openpyxl.utils import get_column_letter
 from botocore.exceptions import ClientError
+from report_common import (PIPELINE_DONE, REPORT_CACHE_DIR, LAST_DELIVERED, LocalReportCache, SendRateLimiter,
+                           content_hash, stop_pipeline, subscription_pointer, validate_query_filters,
+                           validate_subscriptions, workbook_bytes)
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -21,10 +29,35 @@ RECIPIENTS = ["04shivm@gmail.com"]    # recipients (verify if in sandbox)
 SUBJECT = "AWS IAM Users & Groups Report"
 ATTACHMENT_FILENAME = "iam_users_groups_report.xlsx"
 
+# Per-recipient filtered reports (event "subscriptions" overrides). Each entry:
+#   {"name": "platform", "recipients": ["lead@example.com"], "groups": ["Admins"]}
+# Omitting "groups" sends the full report. Empty -> one full report to RECIPIENTS.
+SUBSCRIPTIONS = []
+FANOUT_WORKERS = 4
+SES_MAX_SEND_RATE = 1.0       # emails/sec (SES sandbox default)
+
+# Render/delivery cache (see report_common): workbooks are stored by a hash
+# of the row data plus REPORT_TEMPLATE_VERSION (bump it whenever the workbook
+# layout changes). In pipeline mode the workbook is rendered while rows are
+# still being fetched, so a cache hit there skips only the save and the email.
+REPORT_TEMPLATE_VERSION = "1"
+SEND_UNCHANGED = True         # False: skip the email when data matches the last one sent
+
 # Logos (user-provided PhiCommerce webp + recommended AWS PNG)
 PHI_LOGO_URL = "https://test.com/wp-content/uploads/2024/09/logo-300x170.png.webp"
 #AWS_LOGO_URL = "https://a0.awsstatic.com/main/images/logos/aws-logo-color.png"
 
+# Pipelined mode (event {"pipeline": true}): fetch workers push rows into a
+# bounded queue while the writer appends them to the workbook.
+PIPELINE_WORKERS = 8
+PIPELINE_QUEUE_SIZE = 64      # max rows in flight between fetch and render
+
+# Query mode (event {"mode": "query"}): answers filters from a cached snapshot
+# instead of building/sending a report.
+SNAPSHOT_FILE = "/tmp/iam_snapshot.json"
+SNAPSHOT_TTL_SECONDS = 3600
+SNAPSHOT_VERSION = 1          # bump when the snapshot row layout changes
+
 # -------------------------
 # Helper functions
 # -------------------------
@@ -74,6 +107,63 @@ def list_users_in_group(group_name: str) -> list:
             users.append(u.get("UserName"))
     return users
 
+def list_all_users() -> list:
+    users = []
+    paginator = iam.get_paginator("list_users")
+    for page in paginator.paginate():
+        for u in page.get("Users", []):
+            users.append({"UserName": u.get("UserName"), "Arn": u.get("Arn", "")})
+    return users
+
+# Row builders shared by the sequential and pipelined paths
+def build_user_row(user: dict, groups: list = None) -> dict:
+    # groups: the user's group names when already known (pipelined path)
+    uname = user["UserName"]
+    if groups is None:
+        groups = list_groups_for_user(uname)
+    groups_str = ", ".join(sorted(groups)) if groups else ""
+    return {
+        "UserName": uname,
+        "Arn": user.get("Arn", ""),
+        "ConsoleAccess": user_console_access(uname),
+        "MFA": user_mfa_status(uname),
+        "Groups": groups_str
+    }
+
+def build_group_row(group_name: str) -> dict:
+    members = list_users_in_group(group_name)
+    members_str = ", ".join(sorted(members)) if members else ""
+    attached = list_attached_group_policy_names(group_name)
+    attached_str = ", ".join(sorted(attached)) if attached else ""
+    return {
+        "GroupName": group_name,
+        "Users": members_str,
+        "AttachedPolicies": attached_str
+    }
+
+# Sort users by group (alphabetical). Users without groups last.
+def _group_key(item):
+    g = item.get("Groups", "")
+    return (0, g.lower()) if g else (1, item.get("UserName", "").lower())
+
+def user_sheet_values(sr: int, r: dict) -> list:
+    return [
+        sr,
+        r.get("UserName", ""),
+        r.get("Arn", ""),
+        r.get("ConsoleAccess", ""),
+        r.get("MFA", ""),
+        r.get("Groups", ""),
+    ]
+
+def group_sheet_values(sr: int, g: dict) -> list:
+    return [
+        sr,
+        g.get("GroupName", ""),
+        g.get("Users", ""),
+        g.get("AttachedPolicies", ""),
+    ]
+
 # Excel helpers: style and auto column width
 def style_header_row(ws, header_row=1):
     bold = Font(bold=True)
@@ -95,23 +185,41 @@ def apply_table_borders(ws):
             # left align data
             cell.alignment = Alignment(horizontal="left", vertical="center")
 
-def autosize_columns(ws, min_width=8, max_width=50):
-    # compute max length per column
-    dims = {}
-    for row in ws.rows:
-        for cell in row:
-            val = cell.value
-            if val is None:
-                l = 0
-            else:
-                l = len(str(val))
-            col = cell.column
-            dims[col] = max(dims.get(col, 0), l)
+def track_widths(row, dims: dict):
+    for cell in row:
+        val = cell.value
+        if val is None:
+            l = 0
+        else:
+            l = len(str(val))
+        col = cell.column
+        dims[col] = max(dims.get(col, 0), l)
+
+def apply_column_widths(ws, dims: dict, min_width=8, max_width=50):
     for col, max_len in dims.items():
         width = max(min_width, min(max_len + 2, max_width))
         col_letter = get_column_letter(col)
         ws.column_dimensions[col_letter].width = width
 
+def autosize_columns(ws, min_width=8, max_width=50):
+    # compute max length per column
+    dims = {}
+    for row in ws.rows:
+        track_widths(row, dims)
+    apply_column_widths(ws, dims, min_width, max_width)
+
+# Incremental writer: styles one data row and records its widths as it is
+# appended, so the sheet needs no full pass at the end
+def append_data_row(ws, values: list, dims: dict):
+    ws.append(values)
+    thin = Side(border_style="thin", color="FFBBBBBB")
+    border = Border(left=thin, right=thin, top=thin, bottom=thin)
+    row = ws[ws.max_row]
+    for cell in row:
+        cell.border = border
+        cell.alignment = Alignment(horizontal="left", vertical="center")
+    track_widths(row, dims)
+
 # Build workbook with formatting
 def build_workbook(user_rows: list, group_rows: list) -> Workbook:
     wb = Workbook()
@@ -127,14 +235,7 @@ def build_workbook(user_rows: list, group_rows: list) -> Workbook:
 
     sr = 1
     for r in user_rows:
-        ws1.append([
-            sr,
-            r.get("UserName", ""),
-            r.get("Arn", ""),
-            r.get("ConsoleAccess", ""),
-            r.get("MFA", ""),
-            r.get("Groups", ""),
-        ])
+        ws1.append(user_sheet_values(sr, r))
         sr += 1
 
     style_header_row(ws1, header_row=1)
@@ -151,12 +252,7 @@ def build_workbook(user_rows: list, group_rows: list) -> Workbook:
 
     sr = 1
     for g in group_rows:
-        ws2.append([
-            sr,
-            g.get("GroupName", ""),
-            g.get("Users", ""),
-            g.get("AttachedPolicies", ""),
-        ])
+        ws2.append(group_sheet_values(sr, g))
         sr += 1
 
     style_header_row(ws2, header_row=1)
@@ -165,6 +261,258 @@ def build_workbook(user_rows: list, group_rows: list) -> Workbook:
 
     return wb
 
+# -------------------------
+# Pipelined collection + rendering
+# -------------------------
+def _pipeline_fetch(out_q: queue.Queue, stop: threading.Event):
+    # Fetch stage: enrich groups, then users, on a worker pool. put() blocks
+    # when the queue is full, which throttles the workers to the writer's pace.
+    def _push(kind, seq, fn, *args):
+        if stop.is_set():
+            return None
+        try:
+            row = fn(*args)
+        except Exception as e:
+            out_q.put(("error", seq, e))
+            return None
+        out_q.put((kind, seq, row))
+        return row
+
+    try:
+        with ThreadPoolExecutor(max_workers=PIPELINE_WORKERS) as pool:
+            group_jobs = [pool.submit(_push, "group", seq, build_group_row, g.get("GroupName"))
+                          for seq, g in enumerate(list_all_groups())]
+            users = list_all_users()
+
+            # A user's sheet position depends on its Groups column, so collect
+            # every membership before handing out user sequence numbers
+            groups_of = {}
+            for job in group_jobs:
+                g = job.result()
+                if g is None:
+                    return  # error already queued, or the writer stopped us
+                for uname in _split_names(g["Users"]):
+                    groups_of.setdefault(uname, []).append(g["GroupName"])
+
+            # Same order as the sequential sort: _group_key, ties in list_users order
+            ordered = sorted(users, key=lambda u: _group_key(
+                {"UserName": u["UserName"], "Groups": ", ".join(sorted(groups_of.get(u["UserName"], [])))}))
+            for seq, u in enumerate(ordered):
+                pool.submit(_push, "user", seq, build_user_row, u, groups_of.get(u["UserName"], []))
+    except Exception as e:
+        out_q.put(("error", -1, e))
+    finally:
+        out_q.put(PIPELINE_DONE)
+
+def build_workbook_pipelined():
+    """Overlap IAM fetches with rendering; returns (wb, user_rows, group_rows).
+
+    Groups are fetched first: their member lists give every user's Groups
+    column, and so the final user order, before any per-user call is made.
+    Both sheets are then written through reorder buffers as rows arrive, in
+    the same order as the sequential path.
+    """
+    wb = Workbook()
+    ws1 = wb.active
+    ws1.title = "IAM User Report"
+    ws1.append(["Sr. No.", "User", "ARN", "Console Access", "MFA", "Groups"])
+    ws2 = wb.create_sheet(title="IAM Group Report")
+    ws2.append(["Sr. No.", "Group Name", "Users", "Attached Policies"])
+    dims1, dims2 = {}, {}
+    track_widths(ws1[1], dims1)
+    track_widths(ws2[1], dims2)
+
+    out_q = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    stop = threading.Event()
+    fetcher = threading.Thread(target=_pipeline_fetch, args=(out_q, stop), daemon=True)
+    fetcher.start()
+
+    user_rows, group_rows = [], []
+    sheets = {
+        "user": (ws1, dims1, user_sheet_values, user_rows, {}),
+        "group": (ws2, dims2, group_sheet_values, group_rows, {}),
+    }
+    done = False
+    try:
+        while True:
+            item = out_q.get()
+            if item is PIPELINE_DONE:
+                done = True
+                break
+            kind, seq, payload = item
+            if kind == "error":
+                raise payload
+            # Reorder buffer: emit rows strictly by sequence number
+            ws, dims, sheet_values, rows, pending = sheets[kind]
+            pending[seq] = payload
+            while len(rows) in pending:
+                r = pending.pop(len(rows))
+                rows.append(r)
+                append_data_row(ws, sheet_values(len(rows), r), dims)
+    finally:
+        # Fetch or writer failure: stop and drain before propagating
+        if not done:
+            stop_pipeline(out_q, stop, fetcher)
+    fetcher.join()
+
+    for ws, dims in ((ws1, dims1), (ws2, dims2)):
+        style_header_row(ws, header_row=1)
+        apply_column_widths(ws, dims)
+
+    return wb, user_rows, group_rows
+
+# -------------------------
+# Query mode: cached snapshot + in-memory indexes
+# -------------------------
+def collect_report_rows():
+    """Crawl IAM once; returns (user_rows sorted by _group_key, group_rows)."""
+    user_infos = [build_user_row(u) for u in list_all_users()]
+    group_rows = [build_group_row(g.get("GroupName")) for g in list_all_groups()]
+    return sorted(user_infos, key=_group_key), group_rows
+
+def _split_names(value: str) -> list:
+    return [v for v in value.split(", ") if v] if value else []
+
+def build_iam_index(snapshot: dict) -> dict:
+    users = snapshot["users"]
+    groups = snapshot["groups"]
+    idx = {
+        "users": users,
+        "groups": groups,
+        # user filters -> set of positions in users
+        "user_by_name": {},
+        "user_by_group": {},
+        "user_by_policy": {},
+        "user_by_mfa": {},
+        "user_by_console": {},
+        # group filters -> set of positions in groups
+        "group_by_name": {},
+        "group_by_user": {},
+        "group_by_policy": {},
+    }
+    policies_by_group = {}
+    for i, g in enumerate(groups):
+        gname = g.get("GroupName", "")
+        policies = _split_names(g.get("AttachedPolicies", ""))
+        policies_by_group[gname] = policies
+        idx["group_by_name"].setdefault(gname.lower(), set()).add(i)
+        for u in _split_names(g.get("Users", "")):
+            idx["group_by_user"].setdefault(u.lower(), set()).add(i)
+        for p in policies:
+            idx["group_by_policy"].setdefault(p.lower(), set()).add(i)
+
+    for i, u in enumerate(users):
+        idx["user_by_name"].setdefault(u.get("UserName", "").lower(), set()).add(i)
+        idx["user_by_mfa"].setdefault(u.get("MFA", "").lower(), set()).add(i)
+        idx["user_by_console"].setdefault(u.get("ConsoleAccess", "").lower(), set()).add(i)
+        for gname in _split_names(u.get("Groups", "")):
+            idx["user_by_group"].setdefault(gname.lower(), set()).add(i)
+            for p in policies_by_group.get(gname, []):
+                idx["user_by_policy"].setdefault(p.lower(), set()).add(i)
+    return idx
+
+# Filter name -> index key, per query target. "policy" matches managed
+# policies attached to a group the user is in; policies attached directly to
+# the user and inline policies are not collected, so they never match.
+QUERY_FILTERS = {
+    "users": {
+        "user": "user_by_name",
+        "group": "user_by_group",
+        "policy": "user_by_policy",
+        "mfa": "user_by_mfa",
+        "console": "user_by_console",
+    },
+    "groups": {
+        "group": "group_by_name",
+        "user": "group_by_user",
+        "policy": "group_by_policy",
+    },
+}
+
+_query_cache = {"fetched_at": 0, "index": None}
+
+def load_iam_index(max_age: int, refresh: bool = False) -> dict:
+    """Return the indexed snapshot, re-crawling IAM only when it is stale.
+
+    Warm invocations reuse the in-memory index; cold ones fall back to the
+    snapshot file in /tmp before crawling.
+    """
+    now = time.time()
+    if not refresh:
+        if _query_cache["index"] is not None and now - _query_cache["fetched_at"] <= max_age:
+            return _query_cache
+        try:
+            with open(SNAPSHOT_FILE) as f:
+                snapshot = json.load(f)
+            if snapshot.get("version") == SNAPSHOT_VERSION and now - snapshot["fetched_at"] <= max_age:
+                _query_cache.update(fetched_at=snapshot["fetched_at"], index=build_iam_index(snapshot))
+                return _query_cache
+        except (OSError, ValueError, KeyError):
+            pass
+
+    user_rows, group_rows = collect_report_rows()
+    snapshot = {"version": SNAPSHOT_VERSION, "fetched_at": now, "users": user_rows, "groups": group_rows}
+    # Index before persisting so a snapshot that can't be indexed is never stored
+    index = build_iam_index(snapshot)
+    try:
+        with open(SNAPSHOT_FILE, "w") as f:
+            json.dump(snapshot, f)
+    except OSError as e:
+        logger.warning(f"Failed to write IAM snapshot: {e}")
+    _query_cache.update(fetched_at=now, index=index)
+    return _query_cache
+
+def run_iam_query(idx: dict, target: str, filters: dict) -> list:
+    """AND all filters (case-insensitive exact match) and return matching rows.
+
+    A list value acts as an OR over its entries.
+    """
+    rows = idx[target]
+    matched = None
+    for name, value in filters.items():
+        index = idx[QUERY_FILTERS[target][name]]
+        hits = set()
+        for v in (value if isinstance(value, list) else [value]):
+            hits |= index.get(str(v).lower(), set())
+        matched = hits if matched is None else matched & hits
+    positions = range(len(rows)) if matched is None else sorted(matched)
+    return [rows[i] for i in positions]
+
+def handle_query(event: dict) -> dict:
+    target = event.get("target", "users")
+    filters = event.get("filters")
+    if filters is None:
+        filters = {}
+    if not isinstance(target, str) or target not in QUERY_FILTERS:
+        return {"statusCode": 400,
+                "body": json.dumps({"error": f"target must be one of {sorted(QUERY_FILTERS)}"})}
+    error = validate_query_filters(filters, QUERY_FILTERS[target])
+    if error:
+        return {"statusCode": 400, "body": json.dumps({"error": f"{target}: {error}"})}
+
+    try:
+        max_age = int(event.get("max_age", SNAPSHOT_TTL_SECONDS))
+    except (TypeError, ValueError) as e:
+        return {"statusCode": 400, "body": json.dumps({"error": f"Invalid max_age: {e}"})}
+
+    try:
+        cache = load_iam_index(max_age, refresh=bool(event.get("refresh")))
+    except ClientError as e:
+        logger.exception(f"Failed to load IAM snapshot: {e}")
+        return {"statusCode": 500, "body": json.dumps({"error": str(e)})}
+
+    results = run_iam_query(cache["index"], target, filters)
+    body = {
+        "target": target,
+        "filters": filters,
+        "count": len(results),
+        "snapshot_age_seconds": int(time.time() - cache["fetched_at"]),
+        "results": results
+    }
+    if "policy" in filters:
+        body["note"] = "policy matches group-attached managed policies only"
+    return {"statusCode": 200, "body": json.dumps(body)}
+
 # Create raw MIME email with XLSX attachment
 def create_raw_email_with_attachment(sender: str, recipients: list, subject: str, html_body: str, attachment_bytes: bytes, filename: str) -> bytes:
     boundary = "NextPart"
@@ -195,81 +543,9 @@ def create_raw_email_with_attachment(sender: str, recipients: list, subject: str
     raw = "\n".join(parts).encode("utf-8")
     return raw
 
-# -------------------------
-# Lambda handler
-# -------------------------
-def lambda_handler(event, context):
-    logger.info("Starting IAM users & groups report")
-
-    # Get account ID
-    try:
-        aws_account_id = sts.get_caller_identity()["Account"]
-    except Exception:
-        aws_account_id = "Unknown"
-
-    # 1) Users
-    users = []
-    paginator = iam.get_paginator("list_users")
-    for page in paginator.paginate():
-        for u in page.get("Users", []):
-            users.append({"UserName": u.get("UserName"), "Arn": u.get("Arn", "")})
-
-    user_infos = []
-    for u in users:
-        uname = u["UserName"]
-        groups = list_groups_for_user(uname)
-        groups_str = ", ".join(sorted(groups)) if groups else ""
-        user_infos.append({
-            "UserName": uname,
-            "Arn": u.get("Arn", ""),
-            "ConsoleAccess": user_console_access(uname),
-            "MFA": user_mfa_status(uname),
-            "Groups": groups_str
-        })
-
-    # Sort users by group (alphabetical). Users without groups last.
-    def _group_key(item):
-        g = item.get("Groups", "")
-        return (0, g.lower()) if g else (1, item.get("UserName", "").lower())
-    user_infos_sorted = sorted(user_infos, key=_group_key)
-
-    # 2) Groups (all attached policies)
-    groups = list_all_groups()
-    group_rows = []
-    for g in groups:
-        gname = g.get("GroupName")
-        members = list_users_in_group(gname)
-        members_str = ", ".join(sorted(members)) if members else ""
-        attached = list_attached_group_policy_names(gname)
-        attached_str = ", ".join(sorted(attached)) if attached else ""
-        group_rows.append({
-            "GroupName": gname,
-            "Users": members_str,
-            "AttachedPolicies": attached_str
-        })
-
-    # 3) Build workbook
-    wb = build_workbook(user_infos_sorted, group_rows)
-
-    # Save workbook to /tmp and read bytes
-    tmpfile = f"/tmp/{ATTACHMENT_FILENAME}"
-    try:
-        wb.save(tmpfile)
-    except Exception as e:
-        logger.exception(f"Failed to save workbook: {e}")
-        return {"statusCode": 500, "body": "Failed to save workbook"}
-
-    try:
-        with open(tmpfile, "rb") as f:
-            xbytes = f.read()
-    except Exception as e:
-        logger.exception(f"Failed to read generated workbook: {e}")
-        return {"statusCode": 500, "body": "Failed to read workbook"}
-
-    # -------------------------
-    # HTML Email - logos via URLs, same height on white background
-    # Account ID bold centered, summary table below
-    # -------------------------
+# HTML Email - logos via URLs, same height on white background
+# Account ID bold centered, summary table below
+def build_html_body(aws_account_id, user_count: int, group_count: int) -> str:
     html_body = f"""
     <html>
     <body style="font-family: Arial, sans-serif; margin:0; padding:20px; background:#f5f6fa;">
@@ -308,11 +584,11 @@ def lambda_handler(event, context):
                   </tr>
                   <tr>
                     <td style="padding:10px; border-bottom:1px solid #eee;">Total IAM Users</td>
-                    <td align="right" style="padding:10px; border-bottom:1px solid #eee;"><b>{len(user_infos_sorted)}</b></td>
+                    <td align="right" style="padding:10px; border-bottom:1px solid #eee;"><b>{user_count}</b></td>
                   </tr>
                   <tr>
                     <td style="padding:10px; border-bottom:1px solid #eee;">Total IAM Groups</td>
-                    <td align="right" style="padding:10px; border-bottom:1px solid #eee;"><b>{len(group_rows)}</b></td>
+                    <td align="right" style="padding:10px; border-bottom:1px solid #eee;"><b>{group_count}</b></td>
                   </tr>
                 </table>
               </td>
@@ -340,8 +616,174 @@ def lambda_handler(event, context):
     </body>
     </html>
     """
+    return html_body
+
+# -------------------------
+# Content-addressed render/delivery cache
+# -------------------------
+report_cache = LocalReportCache(os.path.join(REPORT_CACHE_DIR, "iam"))
+
+def report_hash(user_rows: list, group_rows: list) -> str:
+    return content_hash(REPORT_TEMPLATE_VERSION, {"users": user_rows, "groups": group_rows})
+
+# -------------------------
+# Subscription fan-out: one crawl, one filtered report per subscriber
+# -------------------------
+def filter_rows_for_groups(user_rows: list, group_rows: list, groups: list):
+    """Restrict the shared rows to the given groups and their members."""
+    if not groups:
+        return user_rows, group_rows
+    wanted = {g.lower() for g in groups}
+    users = [u for u in user_rows
+             if wanted & {g.lower() for g in _split_names(u.get("Groups", ""))}]
+    filtered_groups = [g for g in group_rows if g.get("GroupName", "").lower() in wanted]
+    return users, filtered_groups
+
+def deliver_subscription(sub: dict, user_rows: list, group_rows: list, aws_account_id, limiter: SendRateLimiter,
+                         force_send: bool = False, send_unchanged: bool = SEND_UNCHANGED) -> dict:
+    users, groups = filter_rows_for_groups(user_rows, group_rows, sub.get("groups"))
+    result = {"users": len(users), "groups": len(groups)}
+
+    key = report_hash(users, groups)
+    pointer = subscription_pointer(sub)
+    if report_cache.get_pointer(pointer) == key and not (force_send or send_unchanged):
+        result["skipped"] = "unchanged"
+        return result
+
+    xbytes = report_cache.get(key)
+    result["cached"] = xbytes is not None
+    if xbytes is None:
+        xbytes = workbook_bytes(build_workbook(users, groups))
+        report_cache.put(key, xbytes)
+
+    html_body = build_html_body(aws_account_id, len(users), len(groups))
+    raw = create_raw_email_with_attachment(SENDER, sub["recipients"], SUBJECT, html_body, xbytes, ATTACHMENT_FILENAME)
+    limiter.wait()
+    resp = ses.send_raw_email(RawMessage={'Data': raw})
+    report_cache.set_pointer(pointer, key)
+    result["MessageId"] = resp.get("MessageId")
+    return result
+
+SUBSCRIPTION_FILTERS = {"groups": list}
+
+def fan_out_reports(subscriptions: list, user_rows: list, group_rows: list, aws_account_id,
+                    force_send: bool = False, send_unchanged: bool = SEND_UNCHANGED) -> dict:
+    """Render and send every subscription concurrently from the shared rows."""
+    limiter = SendRateLimiter(SES_MAX_SEND_RATE)
+
+    def _deliver(sub):
+        result = {"name": sub.get("name", ""), "recipients": sub["recipients"]}
+        try:
+            result.update(deliver_subscription(sub, user_rows, group_rows, aws_account_id, limiter,
+                                               force_send, send_unchanged))
+            if "MessageId" in result:
+                logger.info(f"Email sent to {sub['recipients']}, MessageId: {result['MessageId']}")
+        except Exception as e:
+            logger.exception(f"Failed to deliver subscription {result['name']}: {e}")
+            result["error"] = str(e)
+        return result
+
+    with ThreadPoolExecutor(max_workers=FANOUT_WORKERS) as pool:
+        results = list(pool.map(_deliver, subscriptions))
+
+    failed = [r for r in results if "error" in r]
+    sent = [r for r in results if "MessageId" in r]
+    return {
+        "statusCode": 500 if failed else 200,
+        "body": json.dumps({
+            "message": f"{len(sent)} of {len(results)} subscription reports emailed"
+                       f" ({len(results) - len(sent) - len(failed)} unchanged, {len(failed)} failed)",
+            "users": len(user_rows),
+            "groups": len(group_rows),
+            "subscriptions": results
+        })
+    }
+
+# -------------------------
+# Lambda handler
+# -------------------------
+def lambda_handler(event, context):
+    event = event or {}
+
+    # Ad-hoc question: answer from the snapshot, no workbook or email
+    if event.get("mode") == "query":
+        return handle_query(event)
+
+    logger.info("Starting IAM users & groups report")
+
+    # Get account ID
+    try:
+        aws_account_id = sts.get_caller_identity()["Account"]
+    except Exception:
+        aws_account_id = "Unknown"
+
+    force_send = bool(event.get("force_send"))
+    send_unchanged = bool(event.get("send_unchanged", SEND_UNCHANGED))
+
+    subscriptions = event.get("subscriptions", SUBSCRIPTIONS)
+    if subscriptions:
+        error = validate_subscriptions(subscriptions, SUBSCRIPTION_FILTERS)
+        if error:
+            return {"statusCode": 400, "body": json.dumps({"error": error})}
+
+        # Collect once, then render/send one filtered view per subscriber
+        user_infos_sorted, group_rows = collect_report_rows()
+        return fan_out_reports(subscriptions, user_infos_sorted, group_rows, aws_account_id,
+                               force_send, send_unchanged)
+
+    if event.get("pipeline"):
+        # 1-3) Fetch and render concurrently
+        # (rendering overlaps fetching, so the cache below can't skip it)
+        try:
+            wb, user_infos_sorted, group_rows = build_workbook_pipelined()
+        except Exception as e:
+            logger.exception(f"Pipelined report failed: {e}")
+            return {"statusCode": 500, "body": "Failed to collect IAM data"}
+    else:
+        # 1) Users, 2) Groups (all attached policies)
+        user_infos_sorted, group_rows = collect_report_rows()
+        wb = None  # 3) built below only on a cache miss
+
+    # Unchanged since the last email: skip rendering, and sending unless asked
+    key = report_hash(user_infos_sorted, group_rows)
+    if report_cache.get_pointer(LAST_DELIVERED) == key and not (force_send or send_unchanged):
+        logger.info(f"Report unchanged ({key[:12]}), email skipped")
+        return {
+            "statusCode": 200,
+            "body": json.dumps({
+                "message": "Report unchanged since last delivery; email skipped",
+                "users": len(user_infos_sorted),
+                "groups": len(group_rows)
+            })
+        }
+
+    xbytes = report_cache.get(key)
+    if xbytes is None:
+        if wb is None:
+            # 3) Build workbook
+            wb = build_workbook(user_infos_sorted, group_rows)
+
+        # Save workbook to /tmp and read bytes
+        tmpfile = f"/tmp/{ATTACHMENT_FILENAME}"
+        try:
+            wb.save(tmpfile)
+        except Exception as e:
+            logger.exception(f"Failed to save workbook: {e}")
+            return {"statusCode": 500, "body": "Failed to save workbook"}
+
+        try:
+            with open(tmpfile, "rb") as f:
+                xbytes = f.read()
+        except Exception as e:
+            logger.exception(f"Failed to read generated workbook: {e}")
+            return {"statusCode": 500, "body": "Failed to read workbook"}
+
+        report_cache.put(key, xbytes)
+    else:
+        logger.info(f"Reusing cached workbook {key[:12]}")
 
     # Build raw email & send
+    html_body = build_html_body(aws_account_id, len(user_infos_sorted), len(group_rows))
     raw = create_raw_email_with_attachment(SENDER, RECIPIENTS, SUBJECT, html_body, xbytes, ATTACHMENT_FILENAME)
     try:
         resp = ses.send_raw_email(RawMessage={'Data': raw})
@@ -349,6 +791,7 @@ def lambda_handler(event, context):
     except ClientError as e:
         logger.exception(f"Failed to send email via SES: {e}")
         return {"statusCode": 500, "body": "Failed to send email"}
+    report_cache.set_pointer(LAST_DELIVERED, key)
 
     return {
         "statusCode": 200,
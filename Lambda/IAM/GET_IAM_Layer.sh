@@ -1,6 +1,10 @@
 mkdir python
 cd python
 pip3 install openpyxl -t .
+cp ../../Common/report_common.py .
+cd ..
 zip -r openpyxl-layer.zip python
 
 ## This above commands will create a zip files , Please upload this zip file as a layer.
+## The layer also carries Common/report_common.py, which both the IAM and the
+## Security Group Lambdas import, so attach it to both functions.
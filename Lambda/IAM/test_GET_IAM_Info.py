@@ -0,0 +1,235 @@
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "Common"))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import GET_IAM_Info as iam_info  # noqa: E402
+
+# Odd users not divisible by 3 or 5 (u1, u7, ...) are in no group
+USERS = [f"u{i}" for i in range(30)]
+GROUPS = {
+    "Admins": ["u3", "u12", "u27"],
+    "dev": [u for i, u in enumerate(USERS) if i % 2 == 0],
+    "Ops": [u for i, u in enumerate(USERS) if i % 5 == 0],
+}
+
+
+class NoSuchEntity(Exception):
+    pass
+
+
+class FakePaginator:
+
+    def __init__(self, op):
+        self.op = op
+
+    def paginate(self, **kw):
+        if self.op == "list_users":
+            # Two pages, to check list_users order survives pagination
+            yield {"Users": [{"UserName": u, "Arn": f"arn:aws:iam::123:user/{u}"} for u in USERS[:17]]}
+            yield {"Users": [{"UserName": u, "Arn": f"arn:aws:iam::123:user/{u}"} for u in USERS[17:]]}
+        elif self.op == "list_groups":
+            yield {"Groups": [{"GroupName": g} for g in GROUPS]}
+        elif self.op == "list_groups_for_user":
+            yield {"Groups": [{"GroupName": g} for g, members in GROUPS.items() if kw["UserName"] in members]}
+        elif self.op == "get_group":
+            yield {"Users": [{"UserName": u} for u in GROUPS[kw["GroupName"]]]}
+        elif self.op == "list_attached_group_policies":
+            yield {"AttachedPolicies": [{"PolicyName": f"{kw['GroupName']}Policy"}]}
+
+
+class FakeIAM:
+
+    class exceptions:
+        NoSuchEntityException = NoSuchEntity
+
+    def __init__(self, jitter=0.0):
+        self.jitter = jitter
+        self.login_hook = None
+
+    def get_paginator(self, op):
+        return FakePaginator(op)
+
+    def get_login_profile(self, UserName):
+        if self.login_hook:
+            self.login_hook(UserName)
+        time.sleep(random.random() * self.jitter)
+        if int(UserName[1:]) % 3:
+            raise NoSuchEntity(UserName)
+
+    def list_mfa_devices(self, UserName):
+        return {"MFADevices": [{}] if int(UserName[1:]) % 4 == 0 else []}
+
+
+def sheet_values(wb):
+    return {ws.title: [[c.value for c in row] for row in ws.iter_rows()] for ws in wb.worksheets}
+
+
+class PipelinedWorkbookTest(unittest.TestCase):
+
+    def setUp(self):
+        self.real_iam = iam_info.iam
+        iam_info.iam = FakeIAM(jitter=0.003)
+
+    def tearDown(self):
+        iam_info.iam = self.real_iam
+
+    def test_matches_sequential_output(self):
+        user_rows, group_rows = iam_info.collect_report_rows()
+        expected = sheet_values(iam_info.build_workbook(user_rows, group_rows))
+
+        for _ in range(3):
+            wb, p_users, p_groups = iam_info.build_workbook_pipelined()
+            self.assertEqual(p_users, user_rows)
+            self.assertEqual(p_groups, group_rows)
+            self.assertEqual(sheet_values(wb), expected)
+            self.assertEqual(iam_info.report_hash(p_users, p_groups), iam_info.report_hash(user_rows, group_rows))
+
+    def test_user_order(self):
+        _, user_rows, _ = iam_info.build_workbook_pipelined()
+        names = [r["UserName"] for r in user_rows]
+
+        # Sorted by the Groups column; users without groups last, by name
+        grouped = [r for r in user_rows if r["Groups"]]
+        self.assertEqual([r["Groups"].lower() for r in grouped], sorted(r["Groups"].lower() for r in grouped))
+        ungrouped = [r["UserName"] for r in user_rows if not r["Groups"]]
+        self.assertEqual(names[-len(ungrouped):], ungrouped)
+        self.assertEqual(ungrouped, sorted(ungrouped))
+        # Users with the same Groups value keep list_users order
+        dev_only = [r["UserName"] for r in user_rows if r["Groups"] == "dev"]
+        self.assertEqual(dev_only, [u for u in USERS if u in dev_only])
+
+    def test_users_are_written_while_others_are_still_fetched(self):
+        # The last user's login-profile call blocks until the first user row
+        # has been written; an implementation that buffers every user row
+        # until the end would time out here.
+        first_written = threading.Event()
+        user_rows, _ = iam_info.collect_report_rows()
+        last_user = user_rows[-1]["UserName"]
+
+        def hook(username):
+            if username == last_user:
+                first_written.wait(timeout=5)
+
+        real_append = iam_info.append_data_row
+
+        def append(ws, values, dims):
+            if ws.title == "IAM User Report":
+                first_written.set()
+            return real_append(ws, values, dims)
+
+        iam_info.iam.login_hook = hook
+        iam_info.append_data_row = append
+        try:
+            start = time.monotonic()
+            iam_info.build_workbook_pipelined()
+            elapsed = time.monotonic() - start
+        finally:
+            iam_info.append_data_row = real_append
+        self.assertTrue(first_written.is_set())
+        self.assertLess(elapsed, 4)
+
+    def test_fetch_error_propagates_and_stops_threads(self):
+        before = threading.active_count()
+
+        def hook(username):
+            if username == "u7":
+                raise RuntimeError("throttled")
+
+        iam_info.iam.login_hook = hook
+        with self.assertRaisesRegex(RuntimeError, "throttled"):
+            iam_info.build_workbook_pipelined()
+        self.assertEqual(threading.active_count(), before)
+
+    def test_writer_error_stops_threads(self):
+        before = threading.active_count()
+        real_append = iam_info.append_data_row
+
+        def append(ws, values, dims):
+            raise ValueError("bad cell")
+
+        iam_info.append_data_row = append
+        try:
+            with self.assertRaisesRegex(ValueError, "bad cell"):
+                iam_info.build_workbook_pipelined()
+        finally:
+            iam_info.append_data_row = real_append
+        self.assertEqual(threading.active_count(), before)
+
+
+class QueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.real_iam = iam_info.iam
+        self.real_snapshot = iam_info.SNAPSHOT_FILE
+        self.tmp = tempfile.mkdtemp()
+        iam_info.iam = FakeIAM()
+        iam_info.SNAPSHOT_FILE = os.path.join(self.tmp, "iam_snapshot.json")
+        iam_info._query_cache.update(fetched_at=0, index=None)
+
+    def tearDown(self):
+        iam_info.iam = self.real_iam
+        iam_info.SNAPSHOT_FILE = self.real_snapshot
+        iam_info._query_cache.update(fetched_at=0, index=None)
+        shutil.rmtree(self.tmp)
+
+    def handle(self, event):
+        resp = iam_info.handle_query(dict(event, mode="query"))
+        return resp["statusCode"], json.loads(resp["body"])
+
+    def names(self, body, key="UserName"):
+        return sorted((r[key] for r in body["results"]), key=lambda n: (len(n), n))
+
+    def test_filters_are_anded(self):
+        status, body = self.handle({"filters": {"group": "dev", "console": "Yes"}})
+        self.assertEqual(status, 200)
+        self.assertEqual(self.names(body), ["u0", "u6", "u12", "u18", "u24"])
+
+    def test_list_values_are_ored(self):
+        status, body = self.handle({"filters": {"group": ["admins", "OPS"], "mfa": "enabled"}})
+        self.assertEqual(status, 200)
+        self.assertEqual(self.names(body), ["u0", "u12", "u20"])
+        status, body = self.handle({"target": "groups", "filters": {"user": ["u3", "u5"]}})
+        self.assertEqual(self.names(body, "GroupName"), ["Ops", "Admins"])
+
+    def test_policy_filter_uses_group_policies(self):
+        status, body = self.handle({"filters": {"policy": "AdminsPolicy"}})
+        self.assertEqual(self.names(body), ["u3", "u12", "u27"])
+        self.assertIn("group-attached", body["note"])
+        self.assertNotIn("note", self.handle({"filters": {"user": "u3"}})[1])
+
+    def test_handle_query_rejects_bad_filters(self):
+        for event in ({"filters": ["group", "dev"]}, {"filters": "group=dev"},
+                      {"filters": {"group": {"name": "dev"}}}, {"filters": {"group": []}},
+                      {"filters": {"port": 22}}, {"target": ["users"]}, {"target": "roles"},
+                      {"max_age": "soon"}):
+            status, body = self.handle(event)
+            self.assertEqual(status, 400, event)
+            self.assertIn("error", body)
+
+    def test_snapshot_version_mismatch_recrawls(self):
+        self.assertEqual(self.handle({})[0], 200)
+        with open(iam_info.SNAPSHOT_FILE) as f:
+            snapshot = json.load(f)
+        self.assertEqual(snapshot["version"], iam_info.SNAPSHOT_VERSION)
+
+        # An old-layout snapshot on disk is ignored on a cold start
+        snapshot.update(version=None, users=[], groups=[])
+        with open(iam_info.SNAPSHOT_FILE, "w") as f:
+            json.dump(snapshot, f)
+        iam_info._query_cache.update(fetched_at=0, index=None)
+        self.assertEqual(self.handle({})[1]["count"], len(USERS))
+
+
+if __name__ == "__main__":
+    unittest.main()
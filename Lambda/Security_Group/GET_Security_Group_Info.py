@@ -2,10 +2,18 @@ import boto3
 import json
 import logging
 import base64
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
 from openpyxl import Workbook
 from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
 from openpyxl.utils import get_column_letter
+from report_common import (PIPELINE_DONE, REPORT_CACHE_DIR, LocalReportCache, SendRateLimiter,
+                           content_hash, delivery_pointer, stop_pipeline, subscription_pointer,
+                           validate_query_filters, validate_subscriptions, workbook_bytes)
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -20,8 +28,41 @@ RECIPIENTS = ["04shivm@gmail.com"]
 SUBJECT = "AWS Security Group Inbound & Outbound Rules Report"
 ATTACHMENT_FILENAME = "security_group_rules.xlsx"
 
+# Per-recipient filtered reports (event "subscriptions" overrides). Each entry:
+#   {"name": "payments", "recipients": ["lead@example.com"],
+#    "tags": {"Team": "payments"}, "vpcs": ["vpc-0abc"], "security_group_ids": [...]}
+# Filters are ANDed; omit all of them to send the full report.
+# Empty -> one full report to RECIPIENTS.
+SUBSCRIPTIONS = []
+FANOUT_WORKERS = 4
+SES_MAX_SEND_RATE = 1.0       # emails/sec (SES sandbox default)
+
+# Render/delivery cache (see report_common): workbooks are stored by a hash
+# of the row data plus REPORT_TEMPLATE_VERSION (bump it whenever the workbook
+# layout changes). In pipeline mode the workbook is rendered while rows are
+# still being fetched, so a cache hit there skips only the save and the email.
+REPORT_TEMPLATE_VERSION = "1"
+SEND_UNCHANGED = True         # False: skip the email when data matches the last one sent
+
 PHI_LOGO_URL = "https://test.com/wp-content/uploads/2024/09/logo-300x170.png.webp"
 
+# Pipelined mode (event "pipeline": true): SG ids are described in chunks by
+# fetch workers while the writer appends rows to the workbook in input order.
+PIPELINE_WORKERS = 4
+PIPELINE_CHUNK_SIZE = 20
+PIPELINE_QUEUE_SIZE = 8       # max chunks in flight between fetch and render
+
+# Query mode (event "mode": "query"): answers rule filters from a cached
+# snapshot of every SG in the account instead of building/sending a report.
+SNAPSHOT_FILE = "/tmp/sg_snapshot.json"
+SNAPSHOT_TTL_SECONDS = 3600
+SNAPSHOT_VERSION = 2          # bump when the snapshot row layout changes
+
+PORT_PROTOCOLS = {"tcp", "udp", "6", "17"}
+
+SHEET_HEADERS = ["Sr. No", "Security Group Name", "Security Group ID", "Type",
+                 "Port Range", "Protocol", "Target", "Description"]
+
 
 # ----------------------------------------------------------------------
 # EXCEL HELPERS
@@ -49,26 +90,58 @@ def border_table(ws):
             cell.alignment = Alignment(horizontal="left")
 
 
-def autosize(ws):
-    dims = {}
-    for row in ws.rows:
-        for cell in row:
-            text = str(cell.value or "")
-            col = cell.column
-            dims[col] = max(dims.get(col, 0), len(text))
+def track_widths(row, dims):
+    for cell in row:
+        text = str(cell.value or "")
+        col = cell.column
+        dims[col] = max(dims.get(col, 0), len(text))
+
 
+def apply_widths(ws, dims):
     for col, width in dims.items():
         col_letter = get_column_letter(col)
         ws.column_dimensions[col_letter].width = min(max(width + 2, 8), 60)
 
 
+def autosize(ws):
+    dims = {}
+    for row in ws.rows:
+        track_widths(row, dims)
+    apply_widths(ws, dims)
+
+
+def rule_sheet_values(r):
+    return [
+        r.get("SrNo"), r.get("GroupName"), r.get("GroupId"), r.get("Type"),
+        r.get("PortRange"), r.get("Protocol"), r.get("Target"), r.get("Description")
+    ]
+
+
+def append_rule_row(ws, r, dims):
+    """Append one rule/separator row fully styled, for incremental writing."""
+    thin = Side(border_style="thin", color="FFBBBBBB")
+    border = Border(left=thin, right=thin, top=thin, bottom=thin)
+
+    if r.get("Separator"):
+        ws.append([""] * len(SHEET_HEADERS))
+    else:
+        ws.append(rule_sheet_values(r))
+
+    row = ws[ws.max_row]
+    for cell in row:
+        if r.get("Separator"):
+            cell.fill = PatternFill(start_color="FFF0F0F0", fill_type="solid")
+        cell.border = border
+        cell.alignment = Alignment(horizontal="left")
+    track_widths(row, dims)
+
+
 # ----------------------------------------------------------------------
 # BUILD WORKBOOK
 # ----------------------------------------------------------------------
 def build_workbook(inbound_rows, outbound_rows):
     wb = Workbook()
-    headers = ["Sr. No", "Security Group Name", "Security Group ID", "Type",
-               "Port Range", "Protocol", "Target", "Description"]
+    headers = SHEET_HEADERS
 
     # INBOUND SHEET
     ws_in = wb.active
@@ -83,10 +156,7 @@ def build_workbook(inbound_rows, outbound_rows):
                 cell = ws_in.cell(row=row_idx, column=col)
                 cell.fill = PatternFill(start_color="FFF0F0F0", fill_type="solid")
         else:
-            ws_in.append([
-                r.get("SrNo"), r.get("GroupName"), r.get("GroupId"), r.get("Type"),
-                r.get("PortRange"), r.get("Protocol"), r.get("Target"), r.get("Description")
-            ])
+            ws_in.append(rule_sheet_values(r))
 
     style_header(ws_in)
     border_table(ws_in)
@@ -104,10 +174,7 @@ def build_workbook(inbound_rows, outbound_rows):
                 cell = ws_out.cell(row=row_idx, column=col)
                 cell.fill = PatternFill(start_color="FFF0F0F0", fill_type="solid")
         else:
-            ws_out.append([
-                r.get("SrNo"), r.get("GroupName"), r.get("GroupId"), r.get("Type"),
-                r.get("PortRange"), r.get("Protocol"), r.get("Target"), r.get("Description")
-            ])
+            ws_out.append(rule_sheet_values(r))
 
     style_header(ws_out)
     border_table(ws_out)
@@ -150,184 +217,9 @@ def build_raw_email(sender, recipients, subject, html, attachment_bytes, filenam
 
 
 # ----------------------------------------------------------------------
-# HELPERS
-# ----------------------------------------------------------------------
-def combine_targets(rule):
-    parts = []
-
-    for ip in rule.get("IpRanges", []):
-        if ip.get("CidrIp"):
-            parts.append(ip.get("CidrIp"))
-
-    for ip6 in rule.get("Ipv6Ranges", []):
-        if ip6.get("CidrIpv6"):
-            parts.append(ip6.get("CidrIpv6"))
-
-    for pair in rule.get("UserIdGroupPairs", []):
-        if pair.get("GroupId"):
-            parts.append(pair.get("GroupId"))
-
-    seen = set()
-    ordered = []
-
-    for p in parts:
-        if p not in seen:
-            seen.add(p)
-            ordered.append(p)
-
-    return ", ".join(ordered)
-
-
-# ----------------------------------------------------------------------
-# MAIN LAMBDA HANDLER
+# HTML EMAIL (same styling as IAM email)
 # ----------------------------------------------------------------------
-def lambda_handler(event, context):
-    sg_ids = event.get("security_group_ids", [])
-    if not sg_ids:
-        return {"statusCode": 400,
-                "body": json.dumps({"error": "security_group_ids is required in event JSON"})}
-
-    # Describe SGs
-    try:
-        resp = ec2.describe_security_groups(GroupIds=sg_ids)
-        sg_map = {sg["GroupId"]: sg for sg in resp.get("SecurityGroups", [])}
-    except ClientError as e:
-        logger.exception("Failed to describe security groups")
-        return {"statusCode": 500, "body": json.dumps({"error": str(e)})}
-
-    inbound_rows = []
-    outbound_rows = []
-    in_serial = 1
-    out_serial = 1
-
-    # ------------------------------------------------------------------
-    # PROCESS SECURITY GROUPS IN ORDER
-    # ------------------------------------------------------------------
-    for sg_id in sg_ids:
-        sg = sg_map.get(sg_id)
-        if not sg:
-            inbound_rows.append({"Separator": True})
-            outbound_rows.append({"Separator": True})
-            continue
-
-        group_name = sg.get("GroupName", "")
-
-        # ==========================
-        # INBOUND RULES
-        # ==========================
-        ip_perms = sg.get("IpPermissions", [])
-        if ip_perms:
-            for rule in ip_perms:
-                port_range = "All"
-                if "FromPort" in rule and "ToPort" in rule:
-                    if rule["FromPort"] == rule["ToPort"]:
-                        port_range = str(rule["FromPort"])
-                    else:
-                        port_range = f"{rule['FromPort']}-{rule['ToPort']}"
-
-                proto = rule.get("IpProtocol", "All")
-                if proto == "-1":
-                    proto = "All"
-
-                targets = []
-
-                for ip in rule.get("IpRanges", []):
-                    targets.append((ip.get("CidrIp"), ip.get("Description", "")))
-
-                for ip6 in rule.get("Ipv6Ranges", []):
-                    targets.append((ip6.get("CidrIpv6"), ip6.get("Description", "")))
-
-                for pair in rule.get("UserIdGroupPairs", []):
-                    targets.append((pair.get("GroupId"), pair.get("Description", "")))
-
-                if not targets:
-                    targets = [("", "")]
-
-                for tgt, desc in targets:
-                    inbound_rows.append({
-                        "SrNo": in_serial,
-                        "GroupName": group_name,
-                        "GroupId": sg_id,
-                        "Type": "Inbound",
-                        "PortRange": port_range,
-                        "Protocol": proto,
-                        "Target": tgt,
-                        "Description": desc
-                    })
-                    in_serial += 1
-
-        inbound_rows.append({"Separator": True})
-
-        # ==========================
-        # OUTBOUND RULES
-        # ==========================
-        ip_perms_out = sg.get("IpPermissionsEgress", [])
-        if ip_perms_out:
-            for rule in ip_perms_out:
-                port_range = "All"
-                if "FromPort" in rule and "ToPort" in rule:
-                    if rule["FromPort"] == rule["ToPort"]:
-                        port_range = str(rule["FromFromPort"])
-                    else:
-                        port_range = f"{rule['FromPort']}-{rule['ToPort']}"
-
-                proto = rule.get("IpProtocol", "All")
-                if proto == "-1":
-                    proto = "All"
-
-                targets = []
-
-                for ip in rule.get("IpRanges", []):
-                    targets.append((ip.get("CidrIp"), ip.get("Description", "")))
-
-                for ip6 in rule.get("Ipv6Ranges", []):
-                    targets.append((ip6.get("CidrIpv6"), ip6.get("Description", "")))
-
-                for pair in rule.get("UserIdGroupPairs", []):
-                    targets.append((pair.get("GroupId"), pair.get("Description", "")))
-
-                if not targets:
-                    targets = [("", "")]
-
-                for tgt, desc in targets:
-                    outbound_rows.append({
-                        "SrNo": out_serial,
-                        "GroupName": group_name,
-                        "GroupId": sg_id,
-                        "Type": "Outbound",
-                        "PortRange": port_range,
-                        "Protocol": proto,
-                        "Target": tgt,
-                        "Description": desc
-                    })
-                    out_serial += 1
-
-        outbound_rows.append({"Separator": True})
-
-    # ------------------------------------------------------------------
-    # BUILD WORKBOOK
-    # ------------------------------------------------------------------
-    wb = build_workbook(inbound_rows, outbound_rows)
-    tmpfile = f"/tmp/{ATTACHMENT_FILENAME}"
-
-    try:
-        wb.save(tmpfile)
-    except Exception as e:
-        logger.exception("Failed to save workbook")
-        return {"statusCode": 500, "body": json.dumps({"error": str(e)})}
-
-    with open(tmpfile, "rb") as f:
-        xbytes = f.read()
-
-    # Get AWS Account ID
-    try:
-        account_id = sts.get_caller_identity()["Account"]
-    except Exception:
-        account_id = "Unknown"
-
-    # ------------------------------------------------------------------
-    # HTML EMAIL (same styling as IAM email)
-    # ------------------------------------------------------------------
+def build_html(account_id, inbound_count, outbound_count):
     html = f"""
     <html>
     <body style="font-family: Arial, sans-serif; margin:0; padding:20px; background:#f5f6fa;">
@@ -363,14 +255,14 @@ def lambda_handler(event, context):
                   <tr>
                     <td style="padding:10px;">Total Inbound Rules</td>
                     <td align="right" style="padding:10px;">
-                      <b>{len([r for r in inbound_rows if not r.get('Separator')])}</b>
+                      <b>{inbound_count}</b>
                     </td>
                   </tr>
 
                   <tr>
                     <td style="padding:10px;">Total Outbound Rules</td>
                     <td align="right" style="padding:10px;">
-                      <b>{len([r for r in outbound_rows if not r.get('Separator')])}</b>
+                      <b>{outbound_count}</b>
                     </td>
                   </tr>
 
@@ -390,8 +282,582 @@ def lambda_handler(event, context):
     </body>
     </html>
     """
+    return html
+
+
+# ----------------------------------------------------------------------
+# HELPERS
+# ----------------------------------------------------------------------
+def combine_targets(rule):
+    parts = []
+
+    for ip in rule.get("IpRanges", []):
+        if ip.get("CidrIp"):
+            parts.append(ip.get("CidrIp"))
+
+    for ip6 in rule.get("Ipv6Ranges", []):
+        if ip6.get("CidrIpv6"):
+            parts.append(ip6.get("CidrIpv6"))
+
+    for pair in rule.get("UserIdGroupPairs", []):
+        if pair.get("GroupId"):
+            parts.append(pair.get("GroupId"))
+
+    seen = set()
+    ordered = []
+
+    for p in parts:
+        if p not in seen:
+            seen.add(p)
+            ordered.append(p)
+
+    return ", ".join(ordered)
+
+
+def rule_rows(rule, sg_id, group_name, direction):
+    """Expand one IpPermissions entry into report rows (SrNo assigned by caller)."""
+    port_range = "All"
+    if "FromPort" in rule and "ToPort" in rule:
+        if rule["FromPort"] == rule["ToPort"]:
+            port_range = str(rule["FromPort"])
+        else:
+            port_range = f"{rule['FromPort']}-{rule['ToPort']}"
+
+    proto = rule.get("IpProtocol", "All")
+    if proto == "-1":
+        proto = "All"
+
+    targets = []
+
+    for ip in rule.get("IpRanges", []):
+        targets.append((ip.get("CidrIp"), ip.get("Description", "")))
+
+    for ip6 in rule.get("Ipv6Ranges", []):
+        targets.append((ip6.get("CidrIpv6"), ip6.get("Description", "")))
+
+    for pair in rule.get("UserIdGroupPairs", []):
+        targets.append((pair.get("GroupId"), pair.get("Description", "")))
+
+    if not targets:
+        targets = [("", "")]
+
+    return [{
+        "GroupName": group_name,
+        "GroupId": sg_id,
+        "Type": direction,
+        "PortRange": port_range,
+        "Protocol": proto,
+        "Target": tgt,
+        "Description": desc
+    } for tgt, desc in targets]
+
+
+def sg_rows(sg_id, sg):
+    """Inbound and outbound rows for one SG, each ending with a separator."""
+    if not sg:
+        return [{"Separator": True}], [{"Separator": True}]
+
+    group_name = sg.get("GroupName", "")
+    inbound = []
+    outbound = []
+
+    for rule in sg.get("IpPermissions", []):
+        inbound.extend(rule_rows(rule, sg_id, group_name, "Inbound"))
+    inbound.append({"Separator": True})
+
+    for rule in sg.get("IpPermissionsEgress", []):
+        outbound.extend(rule_rows(rule, sg_id, group_name, "Outbound"))
+    outbound.append({"Separator": True})
+
+    return inbound, outbound
+
+
+def rule_count(rows):
+    return len([r for r in rows if not r.get("Separator")])
+
+
+def collect_sg_blocks(sg_ids):
+    """Describe sg_ids once; returns [(sg_id, sg, inbound, outbound)] in input order.
+
+    Rows are not numbered yet so filtered views can be numbered independently.
+    """
+    resp = ec2.describe_security_groups(GroupIds=sg_ids)
+    sg_map = {sg["GroupId"]: sg for sg in resp.get("SecurityGroups", [])}
+    return [(sg_id, sg_map.get(sg_id)) + sg_rows(sg_id, sg_map.get(sg_id)) for sg_id in sg_ids]
+
+
+def flatten_blocks(blocks):
+    """Copy block rows into report order with running SrNo values."""
+    inbound_rows = []
+    outbound_rows = []
+    in_serial = 1
+    out_serial = 1
+    for _, _, inbound, outbound in blocks:
+        inbound = [dict(r) for r in inbound]
+        outbound = [dict(r) for r in outbound]
+        in_serial = number_rows(inbound, in_serial)
+        out_serial = number_rows(outbound, out_serial)
+        inbound_rows.extend(inbound)
+        outbound_rows.extend(outbound)
+    return inbound_rows, outbound_rows
+
+
+def number_rows(rows, serial):
+    """Assign running SrNo values to non-separator rows; returns next serial."""
+    for r in rows:
+        if not r.get("Separator"):
+            r["SrNo"] = serial
+            serial += 1
+    return serial
+
+
+# ----------------------------------------------------------------------
+# PIPELINED COLLECTION + RENDERING
+# ----------------------------------------------------------------------
+def _pipeline_fetch(sg_ids, out_q, stop):
+    # Fetch stage: describe SG chunks on a worker pool. put() blocks when the
+    # queue is full, which throttles the workers to the writer's pace.
+    def _push(seq, chunk):
+        if stop.is_set():
+            return
+        try:
+            resp = ec2.describe_security_groups(GroupIds=chunk)
+            sg_map = {sg["GroupId"]: sg for sg in resp.get("SecurityGroups", [])}
+            out_q.put(("chunk", seq, [sg_rows(i, sg_map.get(i)) for i in chunk]))
+        except Exception as e:
+            out_q.put(("error", seq, e))
+
+    try:
+        with ThreadPoolExecutor(max_workers=PIPELINE_WORKERS) as pool:
+            for seq, start in enumerate(range(0, len(sg_ids), PIPELINE_CHUNK_SIZE)):
+                pool.submit(_push, seq, sg_ids[start:start + PIPELINE_CHUNK_SIZE])
+    finally:
+        out_q.put(PIPELINE_DONE)
+
+
+def build_workbook_pipelined(sg_ids):
+    """Overlap describe calls with rendering; returns (wb, inbound_rows, outbound_rows).
+
+    Chunks are written strictly in sg_ids order via a reorder buffer, so the
+    output matches the sequential path.
+    """
+    wb = Workbook()
+    ws_in = wb.active
+    ws_in.title = "Inbound Rules"
+    ws_out = wb.create_sheet("Outbound Rules")
+    dims_in, dims_out = {}, {}
+    for ws, dims in ((ws_in, dims_in), (ws_out, dims_out)):
+        ws.append(SHEET_HEADERS)
+        track_widths(ws[1], dims)
+
+    out_q = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    stop = threading.Event()
+    fetcher = threading.Thread(target=_pipeline_fetch, args=(sg_ids, out_q, stop), daemon=True)
+    fetcher.start()
+
+    inbound_rows = []
+    outbound_rows = []
+    in_serial = 1
+    out_serial = 1
+    pending = {}
+    next_seq = 0
+    done = False
+
+    try:
+        while True:
+            item = out_q.get()
+            if item is PIPELINE_DONE:
+                done = True
+                break
+            kind, seq, payload = item
+            if kind == "error":
+                raise payload
+
+            pending[seq] = payload
+            while next_seq in pending:
+                for inbound, outbound in pending.pop(next_seq):
+                    in_serial = number_rows(inbound, in_serial)
+                    out_serial = number_rows(outbound, out_serial)
+                    for r in inbound:
+                        append_rule_row(ws_in, r, dims_in)
+                    for r in outbound:
+                        append_rule_row(ws_out, r, dims_out)
+                    inbound_rows.extend(inbound)
+                    outbound_rows.extend(outbound)
+                next_seq += 1
+    finally:
+        # Fetch or writer failure: stop and drain before propagating
+        if not done:
+            stop_pipeline(out_q, stop, fetcher)
+
+    fetcher.join()
+
+    for ws, dims in ((ws_in, dims_in), (ws_out, dims_out)):
+        style_header(ws)
+        apply_widths(ws, dims)
+
+    return wb, inbound_rows, outbound_rows
+
+
+# ----------------------------------------------------------------------
+# QUERY MODE: CACHED SNAPSHOT + IN-MEMORY INDEXES
+# ----------------------------------------------------------------------
+def collect_all_rules():
+    """Describe every SG in the account; returns rule rows without separators."""
+    rows = []
+    paginator = ec2.get_paginator("describe_security_groups")
+    for page in paginator.paginate():
+        for sg in page.get("SecurityGroups", []):
+            for direction, key in (("Inbound", "IpPermissions"), ("Outbound", "IpPermissionsEgress")):
+                for rule in sg.get(key, []):
+                    for r in rule_rows(rule, sg["GroupId"], sg.get("GroupName", ""), direction):
+                        # Raw ports and protocol for the port index; PortRange is display-only
+                        r["VpcId"] = sg.get("VpcId", "")
+                        r["IpProtocol"] = str(rule.get("IpProtocol", "-1")).lower()
+                        r["FromPort"] = rule.get("FromPort")
+                        r["ToPort"] = rule.get("ToPort")
+                        rows.append(r)
+    return rows
+
+
+def build_sg_index(snapshot):
+    rows = snapshot["rules"]
+    idx = {
+        "rules": rows,
+        "group_id": {},
+        "group_name": {},
+        "vpc": {},
+        "direction": {},
+        "protocol": {},
+        "cidr": {},
+        "port": {},          # single-port tcp/udp rules
+        "port_ranges": [],   # (from, to, pos) for ranged tcp/udp rules
+        "port_all": set(),   # all-traffic rules (protocol -1)
+    }
+    for i, r in enumerate(rows):
+        idx["group_id"].setdefault(r["GroupId"].lower(), set()).add(i)
+        idx["group_name"].setdefault(r["GroupName"].lower(), set()).add(i)
+        idx["vpc"].setdefault(r["VpcId"].lower(), set()).add(i)
+        idx["direction"].setdefault(r["Type"].lower(), set()).add(i)
+        idx["protocol"].setdefault(r["Protocol"].lower(), set()).add(i)
+        idx["cidr"].setdefault((r["Target"] or "").lower(), set()).add(i)
+
+        # Only tcp/udp rules have real ports; ICMP etc. use -1/-1 for type/code
+        # and never match a port filter.
+        proto = r["IpProtocol"]
+        lo, hi = r["FromPort"], r["ToPort"]
+        if proto == "-1":
+            idx["port_all"].add(i)
+        elif proto in PORT_PROTOCOLS and lo is not None and hi is not None:
+            if lo == hi:
+                idx["port"].setdefault(lo, set()).add(i)
+            else:
+                idx["port_ranges"].append((lo, hi, i))
+    return idx
+
+
+QUERY_FILTERS = ["group_id", "group_name", "vpc", "direction", "protocol", "cidr", "port"]
+
+_query_cache = {"fetched_at": 0, "index": None}
+
+
+def load_sg_index(max_age, refresh=False):
+    """Return the indexed snapshot, re-describing SGs only when it is stale."""
+    now = time.time()
+    if not refresh:
+        if _query_cache["index"] is not None and now - _query_cache["fetched_at"] <= max_age:
+            return _query_cache
+        try:
+            with open(SNAPSHOT_FILE) as f:
+                snapshot = json.load(f)
+            if snapshot.get("version") == SNAPSHOT_VERSION and now - snapshot["fetched_at"] <= max_age:
+                _query_cache.update(fetched_at=snapshot["fetched_at"], index=build_sg_index(snapshot))
+                return _query_cache
+        except (OSError, ValueError, KeyError):
+            pass
+
+    snapshot = {"version": SNAPSHOT_VERSION, "fetched_at": now, "rules": collect_all_rules()}
+    # Index before persisting so a snapshot that can't be indexed is never stored
+    index = build_sg_index(snapshot)
+    try:
+        with open(SNAPSHOT_FILE, "w") as f:
+            json.dump(snapshot, f)
+    except OSError as e:
+        logger.warning(f"Failed to write SG snapshot: {e}")
+    _query_cache.update(fetched_at=now, index=index)
+    return _query_cache
+
+
+def _port_hits(idx, port):
+    hits = set(idx["port_all"]) | idx["port"].get(port, set())
+    hits.update(i for lo, hi, i in idx["port_ranges"] if lo <= port <= hi)
+    return hits
+
+
+def run_sg_query(idx, filters):
+    """AND all filters; port matches any rule whose range covers it.
+
+    A list value acts as an OR over its entries.
+    """
+    rows = idx["rules"]
+    matched = None
+    for name, value in filters.items():
+        hits = set()
+        for v in (value if isinstance(value, list) else [value]):
+            if name == "port":
+                hits |= _port_hits(idx, v)
+            else:
+                hits |= idx[name].get(str(v).lower(), set())
+        matched = hits if matched is None else matched & hits
+    positions = range(len(rows)) if matched is None else sorted(matched)
+    return [rows[i] for i in positions]
+
+
+def handle_query(event):
+    filters = event.get("filters")
+    if filters is None:
+        filters = {}
+    error = validate_query_filters(filters, QUERY_FILTERS)
+    if error:
+        return {"statusCode": 400, "body": json.dumps({"error": error})}
+    filters = dict(filters)
+
+    if "port" in filters:
+        try:
+            ports = filters["port"]
+            filters["port"] = [int(p) for p in ports] if isinstance(ports, list) else int(ports)
+        except (TypeError, ValueError) as e:
+            return {"statusCode": 400, "body": json.dumps({"error": f"Invalid port: {e}"})}
+
+    try:
+        max_age = int(event.get("max_age", SNAPSHOT_TTL_SECONDS))
+    except (TypeError, ValueError) as e:
+        return {"statusCode": 400, "body": json.dumps({"error": f"Invalid max_age: {e}"})}
+
+    # Optional scope, same key as the report event
+    if event.get("security_group_ids") and "group_id" not in filters:
+        filters["group_id"] = event["security_group_ids"]
+
+    try:
+        cache = load_sg_index(max_age, refresh=bool(event.get("refresh")))
+    except ClientError as e:
+        logger.exception("Failed to load security group snapshot")
+        return {"statusCode": 500, "body": json.dumps({"error": str(e)})}
+
+    results = run_sg_query(cache["index"], filters)
+
+    security_groups = list(dict.fromkeys(r["GroupId"] for r in results))
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "filters": filters,
+            "count": len(results),
+            "security_groups": security_groups,
+            "snapshot_age_seconds": int(time.time() - cache["fetched_at"]),
+            "results": results
+        })
+    }
+
+
+# ----------------------------------------------------------------------
+# CONTENT-ADDRESSED RENDER/DELIVERY CACHE
+# ----------------------------------------------------------------------
+report_cache = LocalReportCache(os.path.join(REPORT_CACHE_DIR, "sg"))
+
+
+def report_hash(inbound_rows, outbound_rows):
+    return content_hash(REPORT_TEMPLATE_VERSION, {"inbound": inbound_rows, "outbound": outbound_rows})
+
+
+def report_pointer(sg_ids, recipients):
+    """Delivery pointer for the main report: one per SG id set + recipient set."""
+    return delivery_pointer([sorted(set(sg_ids)), sorted(recipients)])
+
+
+# ----------------------------------------------------------------------
+# SUBSCRIPTION FAN-OUT: ONE DESCRIBE, ONE FILTERED REPORT PER SUBSCRIBER
+# ----------------------------------------------------------------------
+def sg_matches(sg, sub):
+    """True if the SG passes every filter set on the subscription."""
+    if not any(sub.get(k) for k in ("tags", "vpcs", "security_group_ids")):
+        return True
+    if not sg:
+        return False
+    if sub.get("security_group_ids") and sg["GroupId"] not in sub["security_group_ids"]:
+        return False
+    if sub.get("vpcs") and sg.get("VpcId") not in sub["vpcs"]:
+        return False
+    tags = {t.get("Key"): t.get("Value") for t in sg.get("Tags", [])}
+    return all(tags.get(k) == v for k, v in (sub.get("tags") or {}).items())
+
+
+SUBSCRIPTION_FILTERS = {"tags": dict, "vpcs": list, "security_group_ids": list}
+
+
+def deliver_subscription(sub, blocks, account_id, limiter, force_send=False, send_unchanged=SEND_UNCHANGED):
+    inbound_rows, outbound_rows = flatten_blocks([b for b in blocks if sg_matches(b[1], sub)])
+    result = {
+        "inbound_rules": rule_count(inbound_rows),
+        "outbound_rules": rule_count(outbound_rows)
+    }
+
+    key = report_hash(inbound_rows, outbound_rows)
+    pointer = subscription_pointer(sub)
+    if report_cache.get_pointer(pointer) == key and not (force_send or send_unchanged):
+        result["skipped"] = "unchanged"
+        return result
+
+    xbytes = report_cache.get(key)
+    result["cached"] = xbytes is not None
+    if xbytes is None:
+        xbytes = workbook_bytes(build_workbook(inbound_rows, outbound_rows))
+        report_cache.put(key, xbytes)
+
+    html = build_html(account_id, result["inbound_rules"], result["outbound_rules"])
+    raw = build_raw_email(SENDER, sub["recipients"], SUBJECT, html, xbytes, ATTACHMENT_FILENAME)
+    limiter.wait()
+    resp = ses.send_raw_email(RawMessage={"Data": raw})
+    report_cache.set_pointer(pointer, key)
+    result["MessageId"] = resp.get("MessageId")
+    return result
+
+
+def fan_out_reports(subscriptions, blocks, account_id, force_send=False, send_unchanged=SEND_UNCHANGED):
+    """Render and send every subscription concurrently from the shared blocks."""
+    limiter = SendRateLimiter(SES_MAX_SEND_RATE)
+
+    def _deliver(sub):
+        result = {"name": sub.get("name", ""), "recipients": sub["recipients"]}
+        try:
+            result.update(deliver_subscription(sub, blocks, account_id, limiter, force_send, send_unchanged))
+            if "MessageId" in result:
+                logger.info(f"Email sent to {sub['recipients']}, MessageId: {result['MessageId']}")
+        except Exception as e:
+            logger.exception(f"Failed to deliver subscription {result['name']}")
+            result["error"] = str(e)
+        return result
+
+    with ThreadPoolExecutor(max_workers=FANOUT_WORKERS) as pool:
+        results = list(pool.map(_deliver, subscriptions))
+
+    failed = [r for r in results if "error" in r]
+    sent = [r for r in results if "MessageId" in r]
+    return {
+        "statusCode": 500 if failed else 200,
+        "body": json.dumps({
+            "message": f"{len(sent)} of {len(results)} subscription reports emailed"
+                       f" ({len(results) - len(sent) - len(failed)} unchanged, {len(failed)} failed)",
+            "security_groups": len(blocks),
+            "subscriptions": results
+        })
+    }
+
+
+# ----------------------------------------------------------------------
+# MAIN LAMBDA HANDLER
+# ----------------------------------------------------------------------
+def lambda_handler(event, context):
+    # Ad-hoc question: answer from the snapshot, no workbook or email
+    if event.get("mode") == "query":
+        return handle_query(event)
+
+    sg_ids = event.get("security_group_ids", [])
+    if not sg_ids:
+        return {"statusCode": 400,
+                "body": json.dumps({"error": "security_group_ids is required in event JSON"})}
+
+    force_send = bool(event.get("force_send"))
+    send_unchanged = bool(event.get("send_unchanged", SEND_UNCHANGED))
+
+    subscriptions = event.get("subscriptions", SUBSCRIPTIONS)
+    if subscriptions:
+        error = validate_subscriptions(subscriptions, SUBSCRIPTION_FILTERS)
+        if error:
+            return {"statusCode": 400, "body": json.dumps({"error": error})}
+
+        # Describe once, then render/send one filtered view per subscriber
+        try:
+            blocks = collect_sg_blocks(sg_ids)
+        except ClientError as e:
+            logger.exception("Failed to describe security groups")
+            return {"statusCode": 500, "body": json.dumps({"error": str(e)})}
+
+        try:
+            account_id = sts.get_caller_identity()["Account"]
+        except Exception:
+            account_id = "Unknown"
+
+        return fan_out_reports(subscriptions, blocks, account_id, force_send, send_unchanged)
+
+    if event.get("pipeline"):
+        # Describe, process and render concurrently
+        # (rendering overlaps fetching, so the cache below can't skip it)
+        try:
+            wb, inbound_rows, outbound_rows = build_workbook_pipelined(sg_ids)
+        except ClientError as e:
+            logger.exception("Failed to describe security groups")
+            return {"statusCode": 500, "body": json.dumps({"error": str(e)})}
+    else:
+        # Describe SGs
+        try:
+            blocks = collect_sg_blocks(sg_ids)
+        except ClientError as e:
+            logger.exception("Failed to describe security groups")
+            return {"statusCode": 500, "body": json.dumps({"error": str(e)})}
+
+        # --------------------------------------------------------------
+        # PROCESS SECURITY GROUPS IN ORDER
+        # --------------------------------------------------------------
+        inbound_rows, outbound_rows = flatten_blocks(blocks)
+        wb = None  # built below only on a cache miss
+
+    # ------------------------------------------------------------------
+    # CACHE: skip rendering (and sending, unless asked) for unchanged data
+    # ------------------------------------------------------------------
+    key = report_hash(inbound_rows, outbound_rows)
+    pointer = report_pointer(sg_ids, RECIPIENTS)
+    if report_cache.get_pointer(pointer) == key and not (force_send or send_unchanged):
+        logger.info(f"Report unchanged ({key[:12]}), email skipped")
+        return {
+            "statusCode": 200,
+            "body": json.dumps({
+                "message": "Security group rules unchanged since last delivery; email skipped",
+                "inbound_rules": rule_count(inbound_rows),
+                "outbound_rules": rule_count(outbound_rows)
+            })
+        }
+
+    xbytes = report_cache.get(key)
+    if xbytes is None:
+        if wb is None:
+            # ----------------------------------------------------------
+            # BUILD WORKBOOK
+            # ----------------------------------------------------------
+            wb = build_workbook(inbound_rows, outbound_rows)
+
+        tmpfile = f"/tmp/{ATTACHMENT_FILENAME}"
+
+        try:
+            wb.save(tmpfile)
+        except Exception as e:
+            logger.exception("Failed to save workbook")
+            return {"statusCode": 500, "body": json.dumps({"error": str(e)})}
+
+        with open(tmpfile, "rb") as f:
+            xbytes = f.read()
+
+        report_cache.put(key, xbytes)
+    else:
+        logger.info(f"Reusing cached workbook {key[:12]}")
+
+    # Get AWS Account ID
+    try:
+        account_id = sts.get_caller_identity()["Account"]
+    except Exception:
+        account_id = "Unknown"
 
     # SEND EMAIL
+    html = build_html(account_id, rule_count(inbound_rows), rule_count(outbound_rows))
     raw = build_raw_email(SENDER, RECIPIENTS, SUBJECT, html, xbytes, ATTACHMENT_FILENAME)
 
     try:
@@ -400,12 +866,13 @@ def lambda_handler(event, context):
     except ClientError as e:
         logger.exception("Failed to send email via SES")
         return {"statusCode": 500, "body": json.dumps({"error": str(e)})}
+    report_cache.set_pointer(pointer, key)
 
     return {
         "statusCode": 200,
         "body": json.dumps({
             "message": "Security group rules report generated and emailed",
-            "inbound_rules": len([r for r in inbound_rows if not r.get("Separator")]),
-            "outbound_rules": len([r for r in outbound_rows if not r.get("Separator")])
+            "inbound_rules": rule_count(inbound_rows),
+            "outbound_rules": rule_count(outbound_rows)
         })
     }
@@ -0,0 +1,174 @@
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "Common"))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import GET_Security_Group_Info as sg_info  # noqa: E402
+
+
+def make_sg(i):
+    return {
+        "GroupId": f"sg-{i:04d}",
+        "GroupName": f"app-{i}",
+        "VpcId": f"vpc-{i % 3}",
+        "IpPermissions": [
+            {"IpProtocol": "tcp", "FromPort": 22, "ToPort": 22,
+             "IpRanges": [{"CidrIp": "0.0.0.0/0" if i % 4 == 0 else "10.0.0.0/8", "Description": "ssh"}]},
+            {"IpProtocol": "tcp", "FromPort": 8000, "ToPort": 8100,
+             "Ipv6Ranges": [{"CidrIpv6": "::/0"}], "UserIdGroupPairs": [{"GroupId": "sg-lb"}]},
+        ],
+        "IpPermissionsEgress": [
+            {"IpProtocol": "-1", "IpRanges": [{"CidrIp": "0.0.0.0/0"}]},
+        ],
+    }
+
+
+SGS = {sg["GroupId"]: sg for sg in map(make_sg, range(60))}
+SGS["sg-icmp"] = {
+    "GroupId": "sg-icmp", "GroupName": "icmp", "VpcId": "vpc-9",
+    "IpPermissions": [
+        {"IpProtocol": "icmp", "FromPort": -1, "ToPort": -1, "IpRanges": [{"CidrIp": "0.0.0.0/0"}]},
+        {"IpProtocol": "icmp", "FromPort": 8, "ToPort": 0, "IpRanges": [{"CidrIp": "10.0.0.0/8"}]},
+    ],
+    "IpPermissionsEgress": [],
+}
+
+
+class FakePaginator:
+
+    def paginate(self, **kw):
+        yield {"SecurityGroups": list(SGS.values())}
+
+
+class FakeEC2:
+
+    def __init__(self, jitter=0.0):
+        self.jitter = jitter
+        self.fail_on = None
+
+    def describe_security_groups(self, GroupIds=None):
+        time.sleep(random.random() * self.jitter)
+        if self.fail_on in (GroupIds or []):
+            raise RuntimeError("throttled")
+        return {"SecurityGroups": [SGS[i] for i in (GroupIds or SGS) if i in SGS]}
+
+    def get_paginator(self, op):
+        return FakePaginator()
+
+
+def sheet_values(wb):
+    return {ws.title: [[c.value for c in row] for row in ws.iter_rows()] for ws in wb.worksheets}
+
+
+class PipelinedWorkbookTest(unittest.TestCase):
+
+    # Unknown and repeated ids must come out exactly as in the sequential path
+    SG_IDS = list(SGS)[:45] + ["sg-missing", "sg-0003", "sg-icmp"]
+
+    def setUp(self):
+        self.real_ec2 = sg_info.ec2
+        sg_info.ec2 = FakeEC2(jitter=0.003)
+
+    def tearDown(self):
+        sg_info.ec2 = self.real_ec2
+
+    def test_matches_sequential_output(self):
+        inbound, outbound = sg_info.flatten_blocks(sg_info.collect_sg_blocks(self.SG_IDS))
+        expected = sheet_values(sg_info.build_workbook(inbound, outbound))
+
+        for _ in range(3):
+            wb, p_inbound, p_outbound = sg_info.build_workbook_pipelined(self.SG_IDS)
+            self.assertEqual(p_inbound, inbound)
+            self.assertEqual(p_outbound, outbound)
+            self.assertEqual(sheet_values(wb), expected)
+
+    def test_fetch_error_propagates_and_stops_threads(self):
+        before = threading.active_count()
+        sg_info.ec2.fail_on = "sg-0030"
+        with self.assertRaisesRegex(RuntimeError, "throttled"):
+            sg_info.build_workbook_pipelined(self.SG_IDS)
+        self.assertEqual(threading.active_count(), before)
+
+
+class QueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.real_ec2 = sg_info.ec2
+        self.real_snapshot = sg_info.SNAPSHOT_FILE
+        self.tmp = tempfile.mkdtemp()
+        sg_info.ec2 = FakeEC2()
+        sg_info.SNAPSHOT_FILE = os.path.join(self.tmp, "sg_snapshot.json")
+        sg_info._query_cache.update(fetched_at=0, index=None)
+        self.idx = sg_info.build_sg_index({"rules": sg_info.collect_all_rules()})
+
+    def tearDown(self):
+        sg_info.ec2 = self.real_ec2
+        sg_info.SNAPSHOT_FILE = self.real_snapshot
+        sg_info._query_cache.update(fetched_at=0, index=None)
+        shutil.rmtree(self.tmp)
+
+    def query(self, **filters):
+        return sg_info.run_sg_query(self.idx, filters)
+
+    def handle(self, event):
+        resp = sg_info.handle_query(dict(event, mode="query"))
+        return resp["statusCode"], json.loads(resp["body"])
+
+    def test_single_port(self):
+        rows = self.query(port=22)
+        self.assertEqual(len(rows), 120)
+        self.assertEqual({(r["PortRange"], r["Protocol"]) for r in rows}, {("22", "tcp"), ("All", "All")})
+
+    def test_port_inside_range(self):
+        rows = self.query(port=8050, direction="Inbound")
+        self.assertEqual(len(rows), 120)  # two targets per rule
+        self.assertEqual({r["PortRange"] for r in rows}, {"8000-8100"})
+        self.assertEqual(self.query(port=8000, direction="inbound"), rows)
+        self.assertEqual(self.query(port=8101, direction="inbound"), [])
+
+    def test_icmp_rules_never_match_a_port(self):
+        # ICMP FromPort/ToPort are type/code (-1 = any), not ports
+        for port in (8, 0, -1):
+            self.assertFalse([r for r in self.query(port=port) if r["GroupId"] == "sg-icmp"])
+        self.assertEqual(len(self.query(protocol="icmp")), 2)
+
+    def test_all_traffic_rules_match_every_port(self):
+        all_traffic = self.query(protocol="All")
+        self.assertEqual(len(all_traffic), 60)
+        self.assertEqual(self.query(port=-1), all_traffic)
+        self.assertEqual(self.query(port=65000), all_traffic)
+
+    def test_list_values_are_ored(self):
+        rows = self.query(port=[22, 8050], direction="inbound")
+        self.assertEqual(len(rows), 180)
+        rows = self.query(cidr=["0.0.0.0/0", "::/0"], group_id="sg-0004")
+        self.assertEqual([r["Target"] for r in rows], ["0.0.0.0/0", "::/0", "0.0.0.0/0"])
+
+    def test_handle_query(self):
+        status, body = self.handle({"filters": {"port": "22", "cidr": "0.0.0.0/0", "direction": "Inbound"}})
+        self.assertEqual(status, 200)
+        self.assertEqual(body["count"], 15)
+        self.assertEqual(body["security_groups"], [f"sg-{i:04d}" for i in range(0, 60, 4)])
+        self.assertTrue(os.path.exists(sg_info.SNAPSHOT_FILE))
+
+    def test_handle_query_rejects_bad_filters(self):
+        for filters in (["port", 22], "port=22", {"port": "ssh"}, {"port": [22, "x"]},
+                        {"vpc": {"id": "vpc-1"}}, {"vpc": []}, {"nope": 1}):
+            status, body = self.handle({"filters": filters})
+            self.assertEqual(status, 400, filters)
+            self.assertIn("error", body)
+        self.assertEqual(self.handle({"max_age": "soon"})[0], 400)
+
+
+if __name__ == "__main__":
+    unittest.main()